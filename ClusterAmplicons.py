@@ -1,11 +1,12 @@
 #! ~/anaconda3/bin/python
 
 import sys,argparse
-from src.main import main
+from src.main import main,sweep
 from src.model.models import MODELS, \
                              showModels, \
                              Clustering_Exception
 from src.model.kmer import Kmer_Exception
+from src.utils.kmertable import CACHESIZE
 from src.utils.extract import Extract_Exception
 
 
@@ -19,31 +20,37 @@ DEFAULTTRIM     = 0.1
 DEFMINLEN       = 50
 DEFMAXLEN       = 25000
 DEFAULTPREFIX   = './clustered'
+AUTOEPSMODELS   = ['dbscan','optics']
+DEDUPMODELS     = ['dbscan','kmeans','mbkmeans','knnlouvain']
+
+def epsArg(value):
+    return value if value == 'auto' else float(value)
 
 parser      = argparse.ArgumentParser(prog='ClusterAmplicons.py', description='Clustering by kmer counts')
 subparsers  = parser.add_subparsers(title='subcommands')
-parser_main = subparsers.add_parser('cluster', help='cluster reads')
-parser_main.set_defaults(func=main)
-parser_main.set_defaults(prog=f'{sys.argv[0]} cluster')
-parser_desc = subparsers.add_parser('describe', help='describe models')
-parser_desc.set_defaults(func=showModels)
-parser_desc.set_defaults(prog=f'{sys.argv[0]} describe')
-#describe
-parser_desc.add_argument('-M','--model', dest='model', choices=MODELS.keys(), type=str, default=None,
-                help='Show argmap and defaults for specfic model. Default None (show all)')
+#input, kmer and filter options shared by cluster and sweep
+parser_load = argparse.ArgumentParser(add_help=False)
 
-#cluster
-parser_main.add_argument('-b','--inBAM', dest='inBAM', type=str, default=None,
+#cluster/sweep inputs
+parser_load.add_argument('-b','--inBAM', dest='inBAM', type=str, default=None,
                 help='input BAM of CCS alignments')
-parser_main.add_argument('-Q','--inFastq', dest='inFastq', type=str, default=None,
+parser_load.add_argument('-Q','--inFastq', dest='inFastq', type=str, default=None,
                 help='input BAM of CCS alignments')
-parser_main.add_argument('-j,--njobs', dest='njobs', type=int, default=None,
-                help='j parallel jobs (only for some models). Default 1')
-kmer = parser_main.add_argument_group('kmers')
+parser_load.add_argument('--kmerTable', dest='kmerTable', type=str, default=None,
+                help='npz kmer table from -X --exportFormat npz to cluster instead of counting reads. Pass -b/-Q as well for bam/fastq outputs')
+parser_load.add_argument('-j','--njobs', dest='njobs', type=int, default=None,
+                help='j parallel jobs for kmer counting and some models (-1 for all cpus). Default 1')
+parser_load.add_argument('--threads', dest='threads', type=int, default=1,
+                help='Threads for BAM compression/decompression and indexing, separate from -j. Default 1')
+kmer = parser_load.add_argument_group('kmers')
 kmer.add_argument('-k','--kmer', dest='kmer', type=int, default=DEFAULTKMER,
                 help=f'kmer size for clustering. Default {DEFAULTKMER}')
 kmer.add_argument('-z','--minimizer', dest='minimizer', type=int, default=0,
                 help='group kmers by minimizer of length z. Default 0 (no minimizer)')
+kmer.add_argument('--canonical', dest='canonical', action='store_true', default=False,
+                help='Count each kmer together with its reverse complement (strand-agnostic features), eg for unoriented fastq input. Default False')
+kmer.add_argument('--orient', dest='orient', action='store_true', default=False,
+                help='Reverse complement reads on the opposite strand to the median-length read (minimizer vote) before counting kmers. Default False')
 kmer.add_argument('-H','--noHPcollapse', dest='hpCollapse', nargs='?', type=int, default=1, const=0,
                 help='Collapse all HP to max H length.  Default 1 (collapse all HP to length 1)')
 kmer.add_argument('-T','--trim', dest='trim', type=float, default=DEFAULTTRIM,
@@ -52,24 +59,28 @@ kmer.add_argument('--trimLow', dest='trimLow', type=float, default=None,
                 help=f'Trim kmers with frequency < trim. Over-rides -T. Default None')
 kmer.add_argument('--trimHigh', dest='trimHigh', type=float, default=None,
                 help=f'Trim kmers with frequency > trimHigh. Over-rides -T. Default None')
-clust = parser_main.add_argument_group('cluster')
-clust.add_argument('-M','--model', dest='model', type=str, choices=MODELS.keys(), default=DEFAULTMODEL,
-                help=f'clustering model. See https://scikit-learn.org/stable/modules/clustering.html. Default {DEFAULTMODEL}')
-clust.add_argument('-a','--agg', dest='agg', type=str, choices=['pca','featagg'],default='pca',
-                help='Feature reduction method. Default pca')
-clust.add_argument('-c','--components', dest='components', type=int, default=DEFAULTCOMP,
+kmer.add_argument('--hashFeatures', dest='hashFeatures', type=int, default=0,
+                help='Hash kmers into n signed buckets (eg 262144) for fixed-width features and bounded memory. Default 0 (exact kmers)')
+kmer.add_argument('--discover', dest='discover', type=int, default=0,
+                help='Find kmers within the trim window on a random subsample of n reads, then count only those kmers in all reads. Default 0 (count all kmers)')
+kmer.add_argument('--sketch', dest='sketch', type=int, default=0,
+                help='Cluster (dbscan) on Jaccard distances between bottom-k MinHash sketches of this size, for LSH candidate pairs only, instead of kmer counts/features. eps is a Jaccard distance. Default 0 (kmer counts)')
+kmer.add_argument('--cache', dest='cache', type=str, default=None,
+                help='Directory caching trimmed kmer tables by input and kmer/filter parameters. Reruns with only clustering changes skip loading. Default None (no cache)')
+kmer.add_argument('--cacheSize', dest='cacheSize', type=float, default=CACHESIZE,
+                help=f'Max size of kmer cache in GB, least recently used tables are evicted. Default {CACHESIZE}')
+feat = parser_load.add_argument_group('features')
+feat.add_argument('-a','--agg', dest='agg', type=str, choices=['pca','svd','ipca','featagg'],default='pca',
+                help='Feature reduction method. svd (randomized truncated SVD) and ipca (incremental PCA) run in bounded memory; featagg needs the full dense kmer table. Default pca')
+feat.add_argument('-c','--components', dest='components', type=int, default=DEFAULTCOMP,
                 help=f'Use first c components of PCA/FeatAgg for clustering. Set to 0 for no reduction. Default {DEFAULTCOMP}')
-clust.add_argument('-e','--eps', dest='eps', type=float, default=None,
-                help='eps cluster tolerance. Default None')
-clust.add_argument('-m','--minReads', dest='minReads', type=int, default=DEFAULTMINREADS,
-                help=f'Minimum reads to be a cluster. Default {DEFAULTMINREADS}')
-clust.add_argument('-n','--normalize', dest='normalize', type=str, choices=['l1','l2','none'], default=DEFAULTNORM,
+feat.add_argument('-n','--normalize', dest='normalize', type=str, choices=['l1','l2','none'], default=DEFAULTNORM,
                 help=f'normalization of kmer counts.  Default {DEFAULTNORM}')
-clust.add_argument('-i','--ignoreEnds', dest='ignoreEnds', type=int, default=0,
+feat.add_argument('--dedup', dest='dedup', action='store_true', default=False,
+                help=f'Cluster one read per unique kmer profile, weighted by read count (models {",".join(DEDUPMODELS)}).  Labels apply to all reads. Default False')
+feat.add_argument('-i','--ignoreEnds', dest='ignoreEnds', type=int, default=0,
                 help='ignore i bases at ends of amplicons for clustering.  Default 0')
-clust.add_argument('-P','--params', dest='params', type=str, default=None,
-                help='json file of parameters for specific model. Order of precedence: json > CL-opts > defaults. Default None')
-filt = parser_main.add_argument_group('filter')
+filt = parser_load.add_argument_group('filter')
 filt.add_argument('-r','--region', dest='region', type=str, default=None,
                 help='Target region for selection of reads, format \'[chr]:[start]-[stop]\'.  Example \'4:3076604-3076660\'. \nDefault all reads (no region)')
 filt.add_argument('--extractReference', dest='reference', type=str, default=None,
@@ -83,13 +94,45 @@ filt.add_argument('-L','--maxLength', dest='maxLength', type=int, default=DEFMAX
 filt.add_argument('-w','--whitelist', dest='whitelist', type=str, default=None,
                 help='whitelist of read names to cluster. Default None')
 filt.add_argument('-N','--nReads', dest='nReads', type=int, default=0,
-                help='Randomly downsample to nReads after filtering. Default 0 (all avail reads)')
+                help='Randomly downsample to nReads after filtering, reservoir sampled while reading with seed -s. Default 0 (all avail reads)')
 filt.add_argument('-f','--flanks', dest='flanks', type=str, default=None,
                 help='fasta of flanking/primer sequence. Reads not mapping to both will be filtered. Default None')
 filt.add_argument('-A','--noArtifactFilter', dest='palfilter',  action='store_false', default=True,
                 help='Turn off palindromic-artifact filtering. Default use artifact filter')
 filt.add_argument('-s','--seed', dest='seed',type=int, default=17,
                 help='Random seed for downsampling. Default 17')
+parser_main = subparsers.add_parser('cluster', help='cluster reads', parents=[parser_load])
+parser_main.set_defaults(func=main)
+parser_main.set_defaults(prog=f'{sys.argv[0]} cluster')
+parser_sweep= subparsers.add_parser('sweep', help='compare dbscan eps x minReads settings', parents=[parser_load])
+parser_sweep.set_defaults(func=sweep)
+parser_sweep.set_defaults(prog=f'{sys.argv[0]} sweep')
+parser_desc = subparsers.add_parser('describe', help='describe models')
+parser_desc.set_defaults(func=showModels)
+parser_desc.set_defaults(prog=f'{sys.argv[0]} describe')
+#describe
+parser_desc.add_argument('-M','--model', dest='model', choices=MODELS.keys(), type=str, default=None,
+                help='Show argmap and defaults for specfic model. Default None (show all)')
+#cluster
+clust = parser_main.add_argument_group('cluster')
+clust.add_argument('-M','--model', dest='model', type=str, choices=MODELS.keys(), default=DEFAULTMODEL,
+                help=f'clustering model. See https://scikit-learn.org/stable/modules/clustering.html. Default {DEFAULTMODEL}')
+clust.add_argument('-e','--eps', dest='eps', type=epsArg, default=None,
+                help='eps cluster tolerance, or "auto" to estimate from the k-distance knee (dbscan/optics). Default None')
+clust.add_argument('-m','--minReads', dest='minReads', type=int, default=DEFAULTMINREADS,
+                help=f'Minimum reads to be a cluster. Default {DEFAULTMINREADS}')
+clust.add_argument('-P','--params', dest='params', type=str, default=None,
+                help='json file of parameters for specific model. Order of precedence: json > CL-opts > defaults. Default None')
+clust.add_argument('--lengthBins', dest='lengthBins', action='store_true', default=False,
+                help='Split reads at modes of the read-length distribution and cluster each bin separately (-j processes). Default False')
+clust.add_argument('--binBandwidth', dest='binBandwidth', type=float, default=0,
+                help='Smoothing sd (bp) of the length distribution for --lengthBins. Default 0 (0.2%% of median length)')
+clust.add_argument('--binOverlap', dest='binOverlap', type=int, default=0,
+                help='Cluster reads within binOverlap bp of a length bin boundary in both bins. Default 0')
+clust.add_argument('--fitReads', dest='fitReads', type=int, default=0,
+                help='Fit model on a random subsample of fitReads reads (seed -s) and assign remaining reads to the nearest core/exemplar/centroid. Default 0 (fit all)')
+clust.add_argument('--assignDist', dest='assignDist', type=float, default=None,
+                help='Max distance to nearest cluster reference for --fitReads assignment, farther reads are noise. Default None (eps for dbscan, else no limit)')
 out = parser_main.add_argument_group('output')
 out.add_argument('-p','--prefix', dest='prefix', type=str, default=DEFAULTPREFIX,
                 help=f'Output prefix. Default {DEFAULTPREFIX}')
@@ -107,6 +150,25 @@ out.add_argument('-g','--plotReads', dest='plotReads', type=int, default=None,
                 help='Write pairplot of first g reduced axes for each read.  Default None (no plot)')
 out.add_argument('-X','--exportKmerTable', dest='exportKmerTable', action='store_true',default=False,
                 help='Export kmer count table after trimming. Default False')
+out.add_argument('--exportFormat', dest='exportFormat', type=str, choices=['csv','npz'], default='csv',
+                help='Format of exported kmer table [prefix].kmercounts.[csv|npz]. npz is a compact sparse table readable with --kmerTable. Default csv')
+
+#sweep
+swp = parser_sweep.add_argument_group('sweep')
+swp.add_argument('-e','--eps', dest='eps', type=float, nargs='+', required=True,
+                help='dbscan eps values. With --epsSteps, the min and max of a linear grid')
+swp.add_argument('--epsSteps', dest='epsSteps', type=int, default=0,
+                help='Number of eps values evenly spaced between min and max -e. Default 0 (use -e values)')
+swp.add_argument('-m','--minReads', dest='minReads', type=int, nargs='+', default=[DEFAULTMINREADS],
+                help=f'dbscan minReads values. Default {DEFAULTMINREADS}')
+sout = parser_sweep.add_argument_group('output')
+sout.add_argument('-p','--prefix', dest='prefix', type=str, default=DEFAULTPREFIX,
+                help=f'Output prefix. Table written to [prefix].sweep.csv. Default {DEFAULTPREFIX}')
+sout.add_argument('-X','--exportKmerTable', dest='exportKmerTable', action='store_true',default=False,
+                help='Export kmer count table after trimming. Default False')
+sout.add_argument('--exportFormat', dest='exportFormat', type=str, choices=['csv','npz'], default='csv',
+                help='Format of exported kmer table [prefix].kmercounts.[csv|npz]. npz is a compact sparse table readable with --kmerTable. Default csv')
+parser_sweep.set_defaults(noBam=True,fastq=False,plotReads=None)
 
 try:
     args = parser.parse_args()
@@ -124,6 +186,30 @@ try:
                 args.palfilter = False
             if args.region:
                 print('Fastq Input. Ignoring region')
+        if args.kmerTable and not (args.inBAM or args.inFastq):
+            if not args.noBam:
+                print('Kmer table input. Turning off bam output (-x)')
+                args.noBam = True
+            if args.fastq:
+                print('Kmer table input. Turning off fastq output (-F)')
+                args.fastq = False
+    if getattr(args,'sketch',0):
+        if getattr(args,'model','dbscan') != 'dbscan':
+            raise Clustering_Exception('--sketch clusters with dbscan only')
+        used = [opt for opt,val in [('--kmerTable'  ,args.kmerTable),
+                                    ('--dedup'      ,args.dedup),
+                                    ('-X'           ,args.exportKmerTable),
+                                    ('-e auto'      ,args.eps == 'auto'),
+                                    ('--lengthBins' ,getattr(args,'lengthBins',False)),
+                                    ('--fitReads'   ,getattr(args,'fitReads',0)),
+                                    ('-t'           ,getattr(args,'testPlot',False)),
+                                    ('-g'           ,args.plotReads)] if val]
+        if used:
+            raise Clustering_Exception(f'--sketch cannot be combined with {",".join(used)}')
+    if getattr(args,'eps',None) == 'auto' and args.model not in AUTOEPSMODELS:
+        raise Clustering_Exception(f'--eps auto is only available for {",".join(AUTOEPSMODELS)}')
+    if getattr(args,'dedup',False) and getattr(args,'model','dbscan') not in DEDUPMODELS:
+        raise Clustering_Exception(f'--dedup is only available for models with sample weights: {",".join(DEDUPMODELS)}')
     if hasattr(args,'plotReads'):
         if args.plotReads == 1:
             raise Clustering_Exception('PlotReads argument cannot be 1.  Must be 0 (no plot) or >=2')
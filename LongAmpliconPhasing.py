@@ -51,8 +51,8 @@ def main(parser):
         if ftype != 'bam':
             if args.region is not None:
                 raise LongAmpliconPhasing_Error('Region option can only be used with BAM input')
-            if args.method == 'debruijn':
-                log.warning('Reads should be oriented before running')
+            if args.method == 'debruijn' and not args.orient:
+                log.warning('Reads should be oriented before running (or use --orient)')
         else:
             if args.maxHP !=0 and args.method=='align':
                 log.warning('Reads will be realigned after compression')
@@ -72,7 +72,8 @@ def main(parser):
                              maxLength=args.maxLength,
                              maxHP=args.maxHP,
                              log=log,
-                             nproc=args.nproc)
+                             nproc=args.nproc,
+                             threads=args.threads)
                              #multifunc=getRow)
         varDf   = pileup.varDf
         counts = pileup.recGen.counter
@@ -109,6 +110,7 @@ def main(parser):
                            vTable=varDf,
                            prefix=prefix,
                            nproc=args.nproc, 
+                           threads=args.threads,
                            makeDf=makeDf,
                            log=log,stats=stats)
     elif args.method == 'debruijn':
@@ -121,7 +123,10 @@ def main(parser):
         splitter.loadReads(args.inFile,
                            region=args.region,
                            minLength=args.minLength,
-                           maxLength=args.maxLength)
+                           maxLength=args.maxLength,
+                           threads=args.threads,
+                           orient=args.orient,
+                           template=args.template)
     else:
         raise LongAmpliconPhasing_Error(f'unknown method: {args.method}')
 
@@ -147,7 +152,7 @@ def main(parser):
                             phaser.splitter.stats['clustered reads'],
                             outBED)
             outBAM = f'{prefix}region.bam'
-            writeRegionBam(args.inFile,outBAM,args.region)
+            writeRegionBam(args.inFile,outBAM,args.region,threads=args.threads)
     #fastq
     if args.exportFq:
         if args.inFile.endswith('a'):
@@ -156,7 +161,8 @@ def main(parser):
             ft = 'bam' if args.inFile.endswith('bam') else 'fastq'   
             log.info("Exporting Fastq files")
             exportFastq(args.inFile,ft,prefix,
-                        phaser.clusterMap,region=args.region)
+                        phaser.clusterMap,region=args.region,
+                        threads=args.threads)
     #simple decision tree
     log.info('Writing Splits')
     with open(f'{prefix}clusterSplits.txt','w') as ofile:
@@ -194,7 +200,8 @@ def main(parser):
                                        vTable=None,log=log,
                                        prefix=prefix,
                                        makeDf=makeDf,
-                                       nproc=args.nproc)
+                                       nproc=args.nproc,
+                                       threads=args.threads)
         else:
             vsplitter = splitter
 
@@ -252,8 +259,8 @@ def main(parser):
 
 ###multiproc definitions for pickling
 
-def makeDf(bamfile,reference,region=None,truncate=False):
-    bam = pysam.AlignmentFile(bamfile,'r')
+def makeDf(bamfile,reference,region=None,truncate=False,threads=1):
+    bam = pysam.AlignmentFile(bamfile,'r',threads=threads)
     ref = pysam.FastaFile(reference)
     df  = pd.DataFrame({(column.reference_name,
                          column.reference_pos)  : dict(zip(column.get_query_names(),
@@ -284,6 +291,8 @@ if __name__ == '__main__':
                     help='sample name')
     parser.add_argument('-j', dest='nproc', type=int, default=1,
                     help=f'Number of procs to use for loading data')
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+                    help='Threads for BAM compression/decompression and indexing. Default 1')
     parser.add_argument('--reference', dest='reference', type=str, default=None,
                     help='reference fasta used for alignment.  Required for draft consensus and variant counts')
     parser.add_argument('--region', dest='region', type=str,default=None,
@@ -296,6 +305,8 @@ if __name__ == '__main__':
                     help='Do not split on indels (only for alignm method).  Default use indels')
     parser.add_argument('-i','--ignore', dest='ignore', type=int, default=0,
                     help=f'Ignore first and last N bases when building debruijn graph. Not used for align method. Default 0')
+    parser.add_argument('--orient', dest='orient', action='store_true', default=False,
+                    help='Reverse complement reads on the opposite strand to the --template read (minimizer vote) before building debruijn graph. Not used for align method. Default False')
     parser.add_argument('-p','--prefix', dest='prefix', type=str, default=None,
                     help=f'Output prefix. Default cwd')
     parser.add_argument('-d','--drop', dest='drop', action='store_true', default=False,
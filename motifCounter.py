@@ -19,7 +19,8 @@ def main(parser):
     else:
         extract = True
     seqs        = seqGen(args.inBAM,clusters,extract=extract,
-                         region=args.region,revcomp=args.revcomp)
+                         region=args.region,revcomp=args.revcomp,
+                         threads=args.threads)
     motifs      = args.motifs.split(',')
     motifCounts = getCounts(seqs,motifs,lengthField=DEFAULTLF)
     clusterIdx  = motifCounts.index.map(clusters.cluster.to_dict())
@@ -31,8 +32,8 @@ def main(parser):
 
     return results
 
-def seqGen(bamfile,clusterDf,extract=False,region=None,revcomp=False):
-    bam = pysam.AlignmentFile(bamfile)
+def seqGen(bamfile,clusterDf,extract=False,region=None,revcomp=False,threads=1):
+    bam = pysam.AlignmentFile(bamfile,threads=threads)
     gen = bam.fetch(*getCoordinates(region)) if region else bam
     tr  = rc if revcomp else (lambda x:x)
     parse = (lambda seq,s,e:tr(seq[s:e])) if extract else (lambda seq,s,e:tr(seq))
@@ -67,6 +68,8 @@ if __name__ == '__main__':
                     help='Region (for filtering inout only). Default None')
     parser.add_argument('-R','--revcomp', dest='revcomp', action='store_true', default=False,
                     help='Revcomp sequence relative to reference before counting motifs. Default reference orientation')
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+                    help='Threads for BAM decompression. Default 1')
 
     try:
         main(parser)
@@ -3,20 +3,59 @@ matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors,BallTree
 
 sns.set_style('whitegrid')
 
-def plotEPS(data,minReads,metric):
-    if not metric:
-        metric = 'euclidean'
-    distances,indices = NearestNeighbors(n_neighbors=minReads,
-                                         metric=metric)\
-                                        .fit(data)\
-                                        .kneighbors(data)
+KDISTREADS=5000 #max reads queried for the k-distance curve
+
+def plotEPS(data,minReads,metric,eps=None,maxReads=KDISTREADS,randseed=None):
+    kdist  = kDistances(data,minReads,metric,maxReads=maxReads,randseed=randseed)
     fig,ax = plt.subplots()
-    ax.plot(np.sort(distances[:,-1]))
+    ax.plot(kdist)
+    if eps is None:
+        eps = kdist[findKnee(kdist)]
+    ax.axhline(eps,color='gray',ls='--')
     ax.set_xlabel('Reads')
     ax.set_ylabel('EPS')
-    ax.set_title('Optimal EPS = point of max curvature')
+    ax.set_title(f'Optimal EPS = point of max curvature ({eps:.4g})')
     return fig
+
+def kDistances(data,minReads,metric=None,maxReads=KDISTREADS,randseed=None):
+    '''
+    Sorted distance to the minReads-th neighbor (self included, as DBSCAN
+    min_samples) for up to maxReads randomly chosen reads.  All reads are
+    indexed in a ball tree (if the metric has one) so the sampled distances are exact.
+    '''
+    if not metric:
+        metric = 'euclidean'
+    X   = np.asarray(data)
+    idx = np.arange(len(X))
+    if maxReads and len(X) > maxReads:
+        idx = np.random.RandomState(randseed).choice(len(X),maxReads,replace=False)
+    nn  = NearestNeighbors(n_neighbors=min(minReads,len(X)),
+                           algorithm='ball_tree' if metric in BallTree.valid_metrics else 'auto',
+                           metric=metric).fit(X)
+    distances,_ = nn.kneighbors(X[idx])
+    return np.sort(distances[:,-1])
+
+def findKnee(kdist):
+    '''
+    Index of max curvature of a sorted k-distance curve: the point farthest
+    below the chord from first to last point, both axes scaled to [0,1]
+    '''
+    if len(kdist) < 3 or kdist[-1] == kdist[0]:
+        return len(kdist) - 1
+    x = np.linspace(0,1,len(kdist))
+    y = (kdist - kdist[0]) / (kdist[-1] - kdist[0])
+    return int(np.argmax(x - y))
+
+def estimateEPS(data,minReads,metric=None,maxReads=KDISTREADS,randseed=None):
+    '''returns (eps,curve) with eps at the knee of the k-distance curve'''
+    kdist = kDistances(data,minReads,metric,maxReads=maxReads,randseed=randseed)
+    knee  = findKnee(kdist)
+    curve = pd.DataFrame({'rank' : np.arange(len(kdist)),
+                          'kdist': kdist,
+                          'knee' : np.arange(len(kdist)) == knee})
+    return float(kdist[knee]),curve
@@ -1,70 +1,87 @@
+import numpy as np
+import pandas as pd
+from copy import copy
+from multiprocessing import Pool,cpu_count
 from src.model.kmer   import *
-from src.model.models import MODELS
+from src.model.models import MODELS,dbscanSweep,assignNearest,Clustering_Exception
+from src.model.partition import lengthModes,lengthBins
 from src.utils.bam import addHPtag,exportFastq,stripReadname
 from src.utils.clust import clusterName
-from src.utils.extract import Extract_Exception
+from src.utils.kmertable import loadKmerTable
 
 def main(args):
-    if args.normalize == 'none':
-        args.normalize = None
+    if args.sketch:
+        return clusterSketches(args)
+    if args.lengthBins and not args.testPlot:
+        return clusterLengthBins(args)
+    data,dups = loadData(args)
 
-    #load dataframe with samples(row) by kmer counts (cols)
-    kmertable =  f'{args.prefix}.kmercounts.csv' if args.exportKmerTable else None
-    if args.inBAM:
-        inFile = args.inBAM
-        ftype  = 'bam'
-    elif args.inFastq:
-        inFile = args.inFastq
-        ftype  = 'fastq'
-    else:
-        raise Kmer_Exception('Must have input! Either BAM or Fastq')
-
-    trim = [args.trim,1-args.trim] if args.trim else [0,1]
-    if args.trimLow:
-        trim[0] = args.trimLow
-    if args.trimHigh:
-        trim[1] = args.trimHigh    
-
-    data = loadKmers(inFile,args.minQV,args.kmer,
-                     fileType   =ftype,
-                     collapse   =args.hpCollapse,
-                     region     =args.region,
-                     minLength  =args.minLength,
-                     maxLength  =args.maxLength,
-                     minimizer  =args.minimizer,
-                     ignoreEnds =args.ignoreEnds,
-                     whitelist  =args.whitelist,
-                     flanks     =args.flanks,
-                     trim       =trim,
-                     norm       =args.normalize,
-                     components =args.components,
-                     agg        =args.agg,
-                     extractRef =args.reference,
-                     palfilter  =args.palfilter,
-                     exportKmers=kmertable,
-                     subsample  =args.nReads,
-                     randseed   =args.seed)
+    #estimate eps from the k-distance knee
+    if args.eps == 'auto':
+        args.eps = autoEPS(data,dups,args)
 
     #Plot k-nearest neighbors
     if args.testPlot:
         from src.figures.kdist import plotEPS
         print(f"Plotting distance to {args.minReads} neighbors")
-        f = plotEPS(data,args.minReads,args.normalize)
+        f = plotEPS(allReads(data,dups),args.minReads,modelMetric(args),eps=args.eps,randseed=args.seed)
         f.savefig(f'{args.prefix}.eps_estimator.png')
         return data
 
     #Clustering
     cluster     = MODELS[args.model](args)
-    print(f'Clustering {len(data)} reads with {args.model}\n{printParams(cluster)}')
-    result      = cluster.fit(data)
-    clusterIdx  = result.labels_
+    weight      = dups.weight if dups else None
+    print(f'Clustering {len(data)} {"unique " if dups else ""}reads with {args.model}\n{printParams(cluster)}')
+    result,labels = clusterReads(cluster,data,args,weight)
+    #labels of every read
+    readnames   = dups.names if dups else data.index
+    clusterIdx  = dups.expand(labels) if dups else labels
+    writeClusters(args,readnames,clusterIdx)
+
+    #plot samples
+    if args.plotReads:
+        from src.figures.cluster import plotReads
+        fig = plotReads(data,labels,args.plotReads)
+        fig.savefig(f'{args.prefix}.clusters.png')
+
+    return data,cluster,result
 
+def clusterSketches(args):
+    '''dbscan on Jaccard distances between MinHash sketches of reads'''
+    cluster = MODELS[args.model](args)
+    cluster.model.set_params(metric='precomputed')
+    graph,readnames = loadSketchData(args,maxDist=cluster.model.eps)
+    print(f'Clustering {len(readnames)} reads with {args.model}\n{printParams(cluster)}')
+    result  = cluster.fit(graph)
+    writeClusters(args,readnames,result.labels_)
+    return graph,cluster,result
+
+def clusterLengthBins(args):
+    '''cluster the reads of each length mode on features of their own kmer counts (see clusterPartitions)'''
+    counts,names,kmers,lengths = loadTable(args)
+    if lengths is None:
+        raise Clustering_Exception('Length bins need read lengths. Cluster from -b/-Q or a kmer table exported with this version')
+    print(f'Clustering {len(names)} reads with {args.model} in length bins')
+    labels = clusterPartitions(counts,names,kmers,lengths,args)
+    writeClusters(args,pd.Index(names,name='qname'),labels)
+
+    #plot samples on features of all reads
+    if args.plotReads:
+        from src.figures.cluster import plotReads
+        data,_ = transform(counts,names,kmers,args,dedup=False)
+        fig    = plotReads(data,labels,args.plotReads)
+        fig.savefig(f'{args.prefix}.clusters.png')
+
+    return counts,labels
+
+def writeClusters(args,readnames,clusterIdx):
+    '''clusters file, HP-tagged bam and fastq per cluster'''
     #TODO
     #cluster size and warning if too much noise as frac of total
 
     #write cluster file
     with open(f'{args.prefix}.clusters.txt', 'w') as namefile:
-        grouped = data.groupby(clusterIdx)
+        grouped = pd.Series(readnames).groupby(clusterIdx)
         cnts    = sorted([len(idx) for c,idx in grouped if c!=-1],reverse=True)
         print(f'Writing {len(cnts)} clusters with nreads {",".join(map(str,cnts))}')
         if -1 in grouped.groups:
@@ -73,9 +90,9 @@ def main(args):
             nreads = len(reads)
             name = f'Noise_numreads{nreads}' if clust==-1 else clusterName((clust,nreads))
             namefile.write(f'>{name}\n')
-            namefile.write('\n'.join(reads.index) + '\n')
+            namefile.write('\n'.join(reads) + '\n')
 
-    names      = data.index.map(stripReadname)
+    names      = readnames.map(stripReadname)
     clusterMap = dict(zip(names,clusterIdx))
 
     #tag BAM
@@ -88,15 +105,219 @@ def main(args):
     #export fastq
     if args.fastq:
         print("Exporting fastq")
-        exportFastq(inFile,ftype,args.prefix,clusterMap,region=args.region)
+        exportFastq(args.inBAM or args.inFastq,'bam' if args.inBAM else 'fastq',
+                    args.prefix,clusterMap,region=args.region,threads=args.threads)
 
-    #plot samples
-    if args.plotReads:
-        from src.figures.cluster import plotReads
-        fig = plotReads(data,clusterIdx,args.plotReads)
-        fig.savefig(f'{args.prefix}.clusters.png')
+def autoEPS(data,dups,args,name=''):
+    '''eps at the knee of the k-distance curve; writes the eps and curve to {prefix}{name}.*'''
+    from src.figures.kdist import estimateEPS
+    eps,curve = estimateEPS(allReads(data,dups),args.minReads,modelMetric(args),randseed=args.seed)
+    print(f'Estimated eps {eps:.6g} from distance to {args.minReads} neighbors of {len(curve)} reads')
+    curve.to_csv(f'{args.prefix}{name}.kdist.csv',index=False)
+    with open(f'{args.prefix}{name}.eps.txt','w') as epsfile:
+        epsfile.write(f'{eps}\n')
+    return eps
 
-    return data,cluster,result
+def modelMetric(args):
+    '''distance metric of the model built from args, the units of its eps'''
+    return MODELS[args.model](args).model.get_params().get('metric','euclidean')
+
+def allReads(data,dups=None):
+    '''features of every read, repeating collapsed duplicates'''
+    return data.iloc[dups.inverse] if dups else data
+
+def clusterReads(cluster,data,args,weight=None):
+    '''returns (result,labels) fitting all reads, or a subsample with --fitReads'''
+    if args.fitReads and args.fitReads < len(data):
+        return fitAssign(data,args,weight)
+    result = cluster.fit(data,sampleWeight=weight)
+    return result,result.labels_
+
+def clusterPartitions(counts,names,kmers,lengths,args):
+    '''
+    Cluster each read-length mode separately, in njobs processes.
+    Each bin is normalized and reduced from its own rows of the count table.
+    Reads within binOverlap of a bin boundary are clustered in both bins and
+    keep their own bin's label unless it is noise.  Labels are renumbered
+    globally and clusters left with < minReads reads are noise
+    '''
+    modes,bounds  = lengthModes(lengths,args.binBandwidth,args.minReads)
+    home,neighbor = lengthBins(lengths,bounds,args.binOverlap)
+    print(f'Splitting reads into {len(modes)} length bins with modes {",".join(map(str,modes))}')
+    names   = np.asarray(names)
+    members = [np.flatnonzero((home == b) | (neighbor == b)) for b in range(len(modes))]
+    tasks   = [(counts[idx],names[idx],kmers,args,b) for b,idx in enumerate(members)]
+    nproc   = cpu_count() if args.njobs == -1 else min(args.njobs or 1,len(tasks))
+    if nproc > 1:
+        with Pool(nproc) as pool:
+            results = pool.starmap(clusterBin,tasks)
+    else:
+        results = [clusterBin(*task) for task in tasks]
+
+    labels,fallback = np.full(len(names),-1),np.full(len(names),-1)
+    offset          = 0
+    for b,(idx,binLabels) in enumerate(zip(members,results)):
+        glob   = np.where(binLabels == -1,-1,binLabels + offset)
+        isHome = home[idx] == b
+        labels[idx[isHome]]    = glob[isHome]
+        fallback[idx[~isHome]] = glob[~isHome]
+        offset += binLabels.max() + 1 if len(binLabels) else 0
+    labels = np.where(labels == -1,fallback,labels)
+    #global renumbering, noise stays -1
+    sizes  = pd.Series(labels[labels != -1]).value_counts().sort_index()
+    keep   = sizes.index[sizes >= args.minReads]
+    labels = np.where(np.isin(labels,keep),np.searchsorted(keep,labels),-1)
+    return labels
+
+def clusterBin(counts,names,kmers,args,b):
+    '''labels for the reads of length bin b, clustered on features of its own counts'''
+    if counts.shape[0] < max(args.minReads,args.components+1,2):
+        return np.full(counts.shape[0],-1)
+    data,dups = transform(counts,names,kmers,args)
+    if args.eps == 'auto':
+        args     = copy(args)
+        args.eps = autoEPS(data,dups,args,name=f'.bin{b}')
+    cluster   = MODELS[args.model](args)
+    print(f'Length bin {b}: clustering {len(data)} {"unique " if dups else ""}reads')
+    labels    = clusterReads(cluster,data,args,dups.weight if dups else None)[1]
+    return dups.expand(labels) if dups else np.asarray(labels)
+
+def fitAssign(data,args,weight=None):
+    '''
+    fit on a seeded subsample of fitReads reads and assign the rest to the nearest cluster.
+    The model is fit with minReads (min_samples, min cluster size) scaled to the
+    subsampled fraction of reads, unless set in --params; clusters of all reads
+    with < minReads reads are noise
+    '''
+    fitIdx  = np.sort(np.random.RandomState(args.seed).choice(len(data),args.fitReads,replace=False))
+    isFit   = np.zeros(len(data),dtype=bool)
+    isFit[fitIdx] = True
+    counts  = np.ones(len(data),dtype=int) if weight is None else np.asarray(weight)
+    fitArgs = copy(args)
+    fitArgs.minReads = max(int(round(args.minReads*counts[fitIdx].sum()/counts.sum())),2)
+    cluster = MODELS[args.model](fitArgs)
+    print(f'Fitting {len(fitIdx)} of {len(data)} reads with minReads {fitArgs.minReads}')
+    result  = cluster.fit(data.iloc[fitIdx],sampleWeight=None if weight is None else weight[fitIdx])
+    print(f'Assigning {(~isFit).sum()} reads to nearest cluster')
+    labels  = np.empty(len(data),dtype=int)
+    labels[isFit]  = result.labels_
+    labels[~isFit] = assignNearest(result,data.iloc[fitIdx],result.labels_,data[~isFit],
+                                   maxDist=args.assignDist,njobs=args.njobs)
+    sizes   = pd.Series(counts).groupby(labels).sum()
+    small   = sizes.index[(sizes < args.minReads) & (sizes.index != -1)]
+    labels[np.isin(labels,small)] = -1
+    return result,labels
+
+def sweep(args):
+    epsGrid = np.linspace(min(args.eps),max(args.eps),args.epsSteps).round(8) if args.epsSteps else args.eps
+    if args.sketch:
+        data,_ = loadSketchData(args,maxDist=max(epsGrid))
+        dups   = None
+    else:
+        data,dups = loadData(args)
+    print(f'Sweeping dbscan over {len(epsGrid)} eps x {len(args.minReads)} minReads on {data.shape[0]} reads')
+    table   = dbscanSweep(data,epsGrid,args.minReads,njobs=args.njobs,
+                          sampleWeight=dups.weight if dups else None)
+    table.to_csv(f'{args.prefix}.sweep.csv',index=False)
+    print(table.to_string(index=False))
+    return table
+
+def loadData(args):
+    '''returns (data,dups): reduced features (or kmer counts) for clustering from -b/-Q/--kmerTable and DuplicateReads with --dedup'''
+    counts,names,kmers,_ = loadTable(args)
+    return transform(counts,names,kmers,args)
+
+def transform(counts,names,kmers,args,dedup=None):
+    '''(data,dups) of transformTable with the feature options in args'''
+    return transformTable(counts,names,kmers,
+                          norm       =args.normalize,
+                          components =args.components,
+                          agg        =args.agg,
+                          randseed   =args.seed,
+                          dedup      =args.dedup if dedup is None else dedup)
+
+def loadTable(args):
+    '''returns (counts,names,kmers,lengths) of -b/-Q/--kmerTable, exported with -X'''
+    if args.normalize == 'none':
+        args.normalize = None
+
+    #load sparse samples(row) by kmer counts (cols)
+    kmertable    = f'{args.prefix}.kmercounts.{args.exportFormat}' if args.exportKmerTable else None
+    inFile,ftype = inputFile(args)
+
+    trim = [args.trim,1-args.trim] if args.trim else [0,1]
+    if args.trimLow:
+        trim[0] = args.trimLow
+    if args.trimHigh:
+        trim[1] = args.trimHigh    
+
+    if args.kmerTable:
+        #counted elsewhere, reads are only needed for bam/fastq outputs
+        print(f'Loading kmer table {args.kmerTable}')
+        table = loadKmerTable(args.kmerTable)
+    else:
+        table = loadKmers(inFile,args.minQV,args.kmer,
+                          fileType   =ftype,
+                          collapse   =args.hpCollapse,
+                          region     =args.region,
+                          minLength  =args.minLength,
+                          maxLength  =args.maxLength,
+                          minimizer  =args.minimizer,
+                          ignoreEnds =args.ignoreEnds,
+                          whitelist  =args.whitelist,
+                          flanks     =args.flanks,
+                          trim       =trim,
+                          extractRef =args.reference,
+                          palfilter  =args.palfilter,
+                          subsample  =args.nReads,
+                          randseed   =args.seed,
+                          njobs      =args.njobs,
+                          hashFeatures=args.hashFeatures,
+                          discover   =args.discover,
+                          cacheDir   =args.cache,
+                          cacheSize  =args.cacheSize,
+                          threads    =args.threads,
+                          canonical  =args.canonical,
+                          orient     =args.orient)
+    if kmertable:
+        exportTable(kmertable,*table)
+    return table
+
+def loadSketchData(args,maxDist):
+    '''returns (graph,names): MinHash Jaccard distance graph of reads from -b/-Q'''
+    inFile,ftype = inputFile(args)
+    return loadSketches(inFile,args.minQV,args.kmer,
+                        fileType   =ftype,
+                        collapse   =args.hpCollapse,
+                        region     =args.region,
+                        minLength  =args.minLength,
+                        maxLength  =args.maxLength,
+                        minimizer  =args.minimizer,
+                        ignoreEnds =args.ignoreEnds,
+                        whitelist  =args.whitelist,
+                        flanks     =args.flanks,
+                        extractRef =args.reference,
+                        palfilter  =args.palfilter,
+                        subsample  =args.nReads,
+                        randseed   =args.seed,
+                        njobs      =args.njobs,
+                        threads    =args.threads,
+                        canonical  =args.canonical,
+                        orient     =args.orient,
+                        sketchSize =args.sketch,
+                        maxDist    =maxDist,
+                        minNeighbors=np.max(args.minReads))
+
+def inputFile(args):
+    '''(file,type) of -b/-Q input, (None,None) for --kmerTable'''
+    if args.inBAM:
+        return args.inBAM,'bam'
+    elif args.inFastq:
+        return args.inFastq,'fastq'
+    elif args.kmerTable:
+        return None,None
+    else:
+        raise Kmer_Exception('Must have input! Either BAM, Fastq or kmer table')
 
 def printParams(model):
     return '\n'.join(['\t' + '='.join(map(str,v)) for v in model.defaults.items()])
@@ -0,0 +1,273 @@
+import numpy as np
+from sklearn.base import BaseEstimator,ClusterMixin
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.neighbors import NearestNeighbors,kneighbors_graph
+
+KNN   =10     #default neighbors per read in sparse graphs
+MUTUALKNN=15  #default neighbors for mutual k-NN graphs, sparser than knn graphs
+NPAIRS=100000 #random pairs estimating the median similarity
+
+def knnGraph(X,n_neighbors=KNN,n_jobs=None):
+    '''symmetric sparse k-NN connectivity graph of the rows of X'''
+    g = kneighbors_graph(X,min(n_neighbors,len(X)-1),include_self=False,n_jobs=n_jobs)
+    return g.maximum(g.T).tocsr()
+
+def knnEdges(X,n_neighbors=KNN,n_jobs=None):
+    '''
+    Symmetric k-NN edge list of the rows of X
+    returns (rows,cols,dist) sorted by row then col, each directed pair once.
+    Zero distances (identical reads) are kept
+    '''
+    k         = min(n_neighbors,len(X)-1)
+    dist,idx  = NearestNeighbors(n_neighbors=k,n_jobs=n_jobs).fit(X).kneighbors()
+    src       = np.repeat(np.arange(len(X)),k)
+    rows      = np.concatenate([src,idx.ravel()])
+    cols      = np.concatenate([idx.ravel(),src])
+    dist      = np.concatenate([dist.ravel()]*2)
+    order     = np.lexsort((cols,rows))
+    rows,cols,dist = rows[order],cols[order],dist[order]
+    keep      = np.ones(len(rows),dtype=bool)
+    keep[1:]  = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    return rows[keep],cols[keep],dist[keep]
+
+def mutualKnnEdges(X,n_neighbors=KNN,n_jobs=None):
+    '''
+    Edge list of the mutual k-NN graph: pairs that are each in the other's
+    n_neighbors nearest neighbors
+    returns (rows,cols,dist) with each edge in both directions
+    '''
+    k         = min(n_neighbors,len(X)-1)
+    dist,idx  = NearestNeighbors(n_neighbors=k,n_jobs=n_jobs).fit(X).kneighbors()
+    rows      = np.repeat(np.arange(len(X)),k)
+    cols      = idx.ravel()
+    dist      = dist.ravel()
+    fwd       = rows*len(X) + cols
+    mutual    = np.isin(fwd,cols*len(X) + rows)
+    return rows[mutual],cols[mutual],dist[mutual]
+
+class KnnAgglomerative(BaseEstimator,ClusterMixin):
+    '''
+    Agglomerative clustering merging only along k-NN graph edges.
+    Memory scales with N*k instead of N^2
+    '''
+    def __init__(self,n_neighbors=KNN,linkage='ward',
+                 distance_threshold=None,n_clusters=None,n_jobs=None):
+        self.n_neighbors        = n_neighbors
+        self.linkage            = linkage
+        self.distance_threshold = distance_threshold
+        self.n_clusters         = n_clusters
+        self.n_jobs             = n_jobs
+
+    def fit(self,X,y=None):
+        conn         = knnGraph(X,self.n_neighbors,n_jobs=self.n_jobs)
+        self.model_  = AgglomerativeClustering(n_clusters=self.n_clusters,
+                                               linkage=self.linkage,
+                                               connectivity=conn,
+                                               distance_threshold=self.distance_threshold,
+                                               compute_full_tree=True).fit(X)
+        self.labels_ = self.model_.labels_
+        return self
+
+class SparseAffinityPropagation(BaseEstimator,ClusterMixin):
+    '''
+    Affinity propagation passing messages only along k-NN graph edges.
+    Similarity is negative squared euclidean distance and preference defaults
+    to the median similarity of all pairs (estimated from random pairs), as in
+    sklearn. Memory scales with N*k.
+    As in sklearn, each cluster's exemplar is then re-picked as the member with
+    the largest summed similarity from the other members (over stored edges)
+    and reads are reassigned.
+    Reads with no edge to an exemplar are labeled noise (-1)
+    '''
+    def __init__(self,n_neighbors=KNN,preference=None,damping=0.5,
+                 max_iter=200,convergence_iter=15,random_state=0,n_jobs=None):
+        self.n_neighbors      = n_neighbors
+        self.preference       = preference
+        self.damping          = damping
+        self.max_iter         = max_iter
+        self.convergence_iter = convergence_iter
+        self.random_state     = random_state
+        self.n_jobs           = n_jobs
+
+    def fit(self,X,y=None):
+        X              = np.asarray(X)
+        n              = len(X)
+        rows,cols,dist = knnEdges(X,self.n_neighbors,n_jobs=self.n_jobs)
+        sim            = -dist**2
+        rng            = np.random.RandomState(self.random_state)
+        if self.preference is None:
+            i,j  = rng.randint(n,size=(2,min(NPAIRS,n*n)))
+            pref = -np.median(((X[i] - X[j])**2).sum(axis=1))
+        else:
+            pref = self.preference
+        #self edges hold the preference
+        rows   = np.concatenate([rows,np.arange(n)])
+        cols   = np.concatenate([cols,np.arange(n)])
+        S      = np.concatenate([sim,np.full(n,pref,dtype=float)])
+        order  = np.argsort(rows,kind='stable')
+        rows,cols,S = rows[order],cols[order],S[order]
+        #remove degeneracies as in sklearn
+        S     += (np.finfo(float).eps*S + np.finfo(float).tiny*100)*rng.standard_normal(len(S))
+
+        starts  = np.concatenate([[0],np.cumsum(np.bincount(rows,minlength=n))[:-1]])
+        isSelf  = rows == cols
+        selfIdx = np.flatnonzero(isSelf) #one per read, in read order
+        R,A     = np.zeros_like(S),np.zeros_like(S)
+        history = np.zeros((n,self.convergence_iter),dtype=bool)
+        for it in range(self.max_iter):
+            #responsibilities: s(i,k) - max over other k' of a(i,k')+s(i,k')
+            AS       = A + S
+            max1     = np.maximum.reduceat(AS,starts)
+            first    = self._rowArgmax(AS,rows,max1)
+            AS[first]= -np.inf
+            max2     = np.maximum.reduceat(AS,starts)
+            Rnew     = S - max1[rows]
+            Rnew[first] = S[first] - max2
+            R        = self.damping*R + (1-self.damping)*Rnew
+            #availabilities from positive responsibilities into each candidate exemplar
+            Rp       = np.maximum(R,0)
+            Rp[isSelf] = R[isSelf]
+            Anew     = np.bincount(cols,weights=Rp,minlength=n)[cols] - Rp
+            Anew[~isSelf] = np.minimum(Anew[~isSelf],0)
+            A        = self.damping*A + (1-self.damping)*Anew
+            #convergence: exemplars unchanged for convergence_iter iterations
+            E        = (A[selfIdx] + R[selfIdx]) > 0
+            history[:,it % self.convergence_iter] = E
+            if it >= self.convergence_iter:
+                stable = history.all(axis=1) | ~history.any(axis=1)
+                if stable.all() and E.any():
+                    break
+        self.n_iter_ = it + 1
+
+        exemplars = np.flatnonzero(E)
+        labels    = self._assign(rows,cols,S,exemplars,n)
+        exemplars = self._refine(rows,cols,S,labels,n)
+        self.cluster_centers_indices_ = exemplars
+        self.labels_ = self._assign(rows,cols,S,exemplars,n)
+        return self
+
+    @staticmethod
+    def _rowArgmax(vals,rows,rowMax):
+        '''index of the first maximum in each row'''
+        hits    = np.flatnonzero(vals == rowMax[rows])
+        _,first = np.unique(rows[hits],return_index=True)
+        return hits[first]
+
+    @staticmethod
+    def _refine(rows,cols,S,labels,n):
+        '''per cluster, the member with the largest summed in-cluster similarity (self edge included)'''
+        inner  = (labels[rows] == labels[cols]) & (labels[rows] >= 0)
+        score  = np.full(n,-np.inf)
+        member = labels >= 0
+        score[member] = np.bincount(cols[inner],weights=S[inner],minlength=n)[member]
+        cand   = np.flatnonzero(member)
+        order  = np.lexsort((-score[cand],labels[cand]))
+        cand   = cand[order]
+        first  = np.ones(len(cand),dtype=bool)
+        first[1:] = labels[cand[1:]] != labels[cand[:-1]]
+        return np.sort(cand[first])
+
+    @staticmethod
+    def _assign(rows,cols,S,exemplars,n):
+        '''label each read by its most similar neighboring exemplar'''
+        labels = np.full(n,-1)
+        if len(exemplars) == 0:
+            return labels
+        clust        = np.full(n,-1)
+        clust[exemplars] = np.arange(len(exemplars))
+        toEx         = clust[cols] >= 0
+        r,c,s        = rows[toEx],cols[toEx],S[toEx]
+        order        = np.lexsort((-s,r))
+        r,c          = r[order],c[order]
+        first        = np.ones(len(r),dtype=bool)
+        first[1:]    = r[1:] != r[:-1]
+        labels[r[first]]  = clust[c[first]]
+        labels[exemplars] = np.arange(len(exemplars))
+        return labels
+
+class KnnLouvain(BaseEstimator,ClusterMixin):
+    '''
+    Louvain communities of the mutual k-NN graph of reads.
+    Identical rows are one node standing for all their reads, so piles of
+    duplicate reads do not fill every k-NN list and split into cliques; edge
+    weights count read pairs and each node has a self loop for its copies.
+    Each level moves a random half of the improving nodes at a time to the
+    neighboring community with the largest modularity gain (all nodes scored
+    at once) until none gain, then merges communities into nodes for the next level.
+    Cost per pass is linear in edges.  Reads with no mutual neighbors are
+    singletons
+    '''
+    def __init__(self,n_neighbors=MUTUALKNN,resolution=1.0,max_iter=100,random_state=0,n_jobs=None):
+        self.n_neighbors  = n_neighbors
+        self.resolution   = resolution
+        self.max_iter     = max_iter
+        self.random_state = random_state
+        self.n_jobs       = n_jobs
+
+    def fit(self,X,y=None,sample_weight=None):
+        X              = np.asarray(X)
+        nodes,inv      = np.unique(X,axis=0,return_inverse=True)
+        inv            = inv.ravel()
+        n              = len(nodes)
+        mult           = np.bincount(inv,weights=sample_weight,minlength=n)
+        if n < 2:
+            self.n_levels_,self.labels_ = 0,np.zeros(len(X),dtype=int)
+            return self
+        rows,cols,_    = mutualKnnEdges(nodes,self.n_neighbors,n_jobs=self.n_jobs)
+        rows           = np.concatenate([rows,np.arange(n)])
+        cols           = np.concatenate([cols,np.arange(n)])
+        weight         = np.concatenate([mult[rows[:-n]]*mult[cols[:-n]],mult*(mult-1)])
+        rng            = np.random.RandomState(self.random_state)
+        members        = np.arange(n)
+        for level in range(n):
+            labels = self._moveNodes(rows,cols,weight,n,rng)
+            ncomm  = labels.max() + 1
+            if ncomm == n:
+                break
+            members        = labels[members]
+            rows,cols,weight = self._aggregate(rows,cols,weight,labels,n)
+            n              = ncomm
+        self.n_levels_ = level + 1
+        self.labels_   = members[inv]
+        return self
+
+    def _moveNodes(self,rows,cols,weight,n,rng):
+        '''one Louvain level: community of each node, numbered 0..ncomm-1'''
+        degree    = np.bincount(rows,weights=weight,minlength=n)
+        total     = degree.sum() #2m
+        link      = rows != cols
+        r,c,w     = rows[link],cols[link],weight[link]
+        labels    = np.arange(n)
+        for it in range(self.max_iter):
+            commDeg   = np.bincount(labels,weights=degree,minlength=n)
+            key       = r*n + labels[c]
+            uniq,kinv = np.unique(key,return_inverse=True)
+            kin       = np.bincount(kinv.ravel(),weights=w) #weight from node to community
+            node,comm = uniq // n,uniq % n
+            own       = comm == labels[node]
+            #gain of joining comm vs staying alone, own community without the node
+            others    = commDeg[comm] - np.where(own,degree[node],0)
+            score     = kin - self.resolution*degree[node]*others/total
+            stay      = -self.resolution*degree*(commDeg[labels] - degree)/total
+            stay[node[own]] = score[own]
+            order     = np.lexsort((-score,node))
+            first     = np.ones(len(order),dtype=bool)
+            first[1:] = node[order][1:] != node[order][:-1]
+            best      = order[first]
+            bestComm  = labels.copy()
+            bestScore = np.full(n,-np.inf)
+            bestComm[node[best]]  = comm[best]
+            bestScore[node[best]] = score[best]
+            gain      = (bestComm != labels) & (bestScore > stay + 1e-12)
+            if not gain.any():
+                break
+            move      = gain & (rng.random_sample(n) < 0.5)
+            labels[move] = bestComm[move]
+        return np.unique(labels,return_inverse=True)[1].ravel()
+
+    @staticmethod
+    def _aggregate(rows,cols,weight,labels,n):
+        '''graph of communities with summed edge weights, internal edges as self loops'''
+        key       = labels[rows]*n + labels[cols]
+        uniq,inv  = np.unique(key,return_inverse=True)
+        return uniq // n,uniq % n,np.bincount(inv.ravel(),weights=weight)
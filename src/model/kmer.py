@@ -1,21 +1,52 @@
-import re,pysam
-from collections import defaultdict
-from multiprocessing import Pool,Manager,cpu_count
+import os,math,random,hashlib,pysam
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool,cpu_count
 import pandas as pd
 import numpy as np
-import mappy as mp
+from scipy import sparse
 from sklearn.preprocessing import normalize
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA,TruncatedSVD,IncrementalPCA
 from sklearn.cluster import FeatureAgglomeration
+from sklearn.neighbors import kneighbors_graph
 from ..utils.extract import getCoordinates, \
                             extractRegion, \
-                            fastqReader
+                            fastqReader, \
+                            FlankMapper
+from .sketch import sketchReads, \
+                    sketchGraph, \
+                    SKETCHSIZE, \
+                    BANDLINKS
+from ..utils.kmertable import KmerCache, \
+                              saveKmerTable, \
+                              CACHESIZE
+from ..utils.sequence import MAXCODEK, \
+                             AMBIG, \
+                             encodeSeq, \
+                             seqBytes, \
+                             hpMask, \
+                             hpCollapse, \
+                             kmerCodes, \
+                             kmerCode, \
+                             slidingMin, \
+                             stringKey, \
+                             hashCodes, \
+                             decodeKmer, \
+                             windowCount, \
+                             canonicalCodes, \
+                             canonicalKmer, \
+                             orientSeqs, \
+                             revcompSeq
 
 FLANKSIZE=100
 MINLEN   =50
 MAXLEN   =25000
 MAXPALOVR=250 #max rev comp overlap bwtn primary/supp alignments
 RANDSEED =17
+CHUNKSIZE=1000 #reads encoded per batch
+AGGKNN   =10   #kmer neighbors in featagg connectivity
+DENSEMB  =256  #memory budget (MB) of each dense ipca batch
+ALNMETA  =['qname','r_st','r_en','isSecond','isrev']
 
 #_PATT = re.compile(r'([ATGC])\1+')
 #def hpCollapse(seq):
@@ -35,13 +66,6 @@ def getLengthCrit(minLen,maxLen):
         return rlen >= minLen and rlen <= maxLen
     return crit
 
-def getFlankCrit(flankFa):
-    flanks = [seq for _,seq,_ in mp.fastx_read(flankFa)]
-    def includesFlanks(rec):
-        a = mp.Aligner(seq=rec.query_sequence,preset='sr')
-        return np.all([len(list(a.map(f)))==1 for f in flanks])
-    return includesFlanks
-
 #def getMinimizer(m=6):
 #    def minimizer(seq):
 #        return sorted(seq[i:i+m] for i in range(0,len(seq)-m+1))[0]
@@ -53,16 +77,19 @@ def noFilter(x):
 def ident(x):
     return x
 
-def overlap(a,b):
-    return min(a.r_en,b.r_en) - max(a.r_st,b.r_st)
-
-def isArtifact(alns,maxOvr=MAXPALOVR):
-    for i,aln1 in alns.iterrows():
-        for j,aln2 in alns.loc[i:].iterrows():
-            if i==j: continue
-            if overlap(aln1,aln2) > maxOvr and aln1.isrev!=aln2.isrev:
-                return True
-    return False
+def findArtifacts(seqDB,maxOvr=MAXPALOVR):
+    '''
+    Names of reads with a pair of opposite-strand alignments overlapping by
+    more than maxOvr (palindromic artifacts). All forward/reverse pairs of
+    multi-mapped reads are compared at once.
+    '''
+    multi = seqDB.loc[seqDB.qname.isin(seqDB.qname[seqDB.isSecond]),
+                      ['qname','r_st','r_en','isrev']]
+    pairs = multi[~multi.isrev].merge(multi[multi.isrev],
+                                      on='qname',suffixes=('_f','_r'))
+    ovr   = np.minimum(pairs.r_en_f.values,pairs.r_en_r.values) \
+          - np.maximum(pairs.r_st_f.values,pairs.r_st_r.values)
+    return pairs.qname[ovr > maxOvr].unique()
 
 def loadKmers(inFile,qual,k,
               fileType='bam',
@@ -70,26 +97,139 @@ def loadKmers(inFile,qual,k,
               minLength=MINLEN,maxLength=MAXLEN,
               minimizer=0,ignoreEnds=0,
               whitelist=None,flanks=None,
-              trim=None,norm=None,
-              components=3,agg='pca',
+              trim=None,
               extractRef=None,palfilter=True,
-              exportKmers=None,subsample=0,
-              randseed=RANDSEED):
+              subsample=0,
+              randseed=RANDSEED,njobs=1,
+              hashFeatures=0,discover=0,
+              cacheDir=None,cacheSize=CACHESIZE,
+              threads=1,
+              canonical=False,orient=False):
     '''
     kmer loader
+    cacheDir : reuse trimmed kmer tables across runs with the same input and feature parameters
+    threads  : bgzf threads for reading bam input
+    canonical: count a kmer and its reverse complement as one feature
+    orient   : reverse complement reads to a common strand before counting (see loadSequences)
+    returns (counts,names,kmers,lengths) as countTable
+    '''
+    cache,table = None,None
+    if cacheDir and os.path.isfile(inFile):
+        cache = KmerCache(cacheDir,cacheSize)
+        key   = cache.key([inFile,whitelist,flanks,extractRef],
+                          fileType=fileType,qual=qual,k=k,collapse=collapse,
+                          region=region,minLength=minLength,maxLength=maxLength,
+                          minimizer=minimizer,ignoreEnds=ignoreEnds,trim=trim,
+                          palfilter=palfilter,subsample=subsample,randseed=randseed,
+                          hashFeatures=hashFeatures,discover=discover,
+                          canonical=canonical,orient=orient)
+        table = cache.load(key)
+        if table is not None:
+            print(f'Loaded kmer counts from cache {key}')
+
+    if table is None:
+        sequences = loadSequences(inFile,qual,
+                                  fileType  =fileType,
+                                  region    =region,
+                                  minLength =minLength,
+                                  maxLength =maxLength,
+                                  whitelist =whitelist,
+                                  flanks    =flanks,
+                                  extractRef=extractRef,
+                                  palfilter =palfilter,
+                                  subsample =subsample,
+                                  randseed  =randseed,
+                                  njobs     =njobs,
+                                  threads   =threads,
+                                  orient    =orient)
+        parser    = seqParser(k,collapseHP=collapse,
+                              minimizer=minimizer,
+                              ignoreEnds=ignoreEnds,
+                              nFeatures=hashFeatures,
+                              canonical=canonical)
+        table     = countTable(sequences,parser,trim,
+                               discover=discover,
+                               randseed=randseed,
+                               njobs=njobs)
+        if cache:
+            cache.save(key,*table,input=inFile,k=k,trim=trim,region=region)
+
+    return table
+
+def loadSketches(inFile,qual,k,
+                 fileType='bam',
+                 collapse=1,region=None,
+                 minLength=MINLEN,maxLength=MAXLEN,
+                 minimizer=0,ignoreEnds=0,
+                 whitelist=None,flanks=None,
+                 extractRef=None,palfilter=True,
+                 subsample=0,randseed=RANDSEED,
+                 njobs=1,threads=1,
+                 sketchSize=SKETCHSIZE,maxDist=1.0,minNeighbors=0,
+                 canonical=False,orient=False):
+    '''
+    MinHash loader: bottom-k sketches of the same parsed kmers as loadKmers,
+    without a count table or feature reduction
+    minNeighbors: link reads in LSH buckets to at least this many others
+    returns (graph,names): sparse reads x reads Jaccard distances of LSH
+            candidate pairs within maxDist, and read names
+    '''
+    sequences = loadSequences(inFile,qual,
+                              fileType  =fileType,
+                              region    =region,
+                              minLength =minLength,
+                              maxLength =maxLength,
+                              whitelist =whitelist,
+                              flanks    =flanks,
+                              extractRef=extractRef,
+                              palfilter =palfilter,
+                              subsample =subsample,
+                              randseed  =randseed,
+                              njobs     =njobs,
+                              threads   =threads,
+                              orient    =orient)
+    parser    = seqParser(k,collapseHP=collapse,
+                          minimizer=minimizer,
+                          ignoreEnds=ignoreEnds,
+                          canonical=canonical)
+    print(f'Sketching {len(sequences)} reads with {sketchSize} hashes')
+    sketches  = sketchReads(sequences.seq.values,parser,sketchSize,njobs=njobs)
+    graph     = sketchGraph(sketches,maxDist,randseed=randseed,
+                            links=max(BANDLINKS,minNeighbors))
+    print(f'Found {graph.nnz//2} read pairs within distance {maxDist}')
+    return graph,pd.Index(sequences.qname.values,name='qname')
+
+def loadSequences(inFile,qual,
+                  fileType='bam',region=None,
+                  minLength=MINLEN,maxLength=MAXLEN,
+                  whitelist=None,flanks=None,
+                  extractRef=None,palfilter=True,
+                  subsample=0,randseed=RANDSEED,njobs=1,threads=1,
+                  orient=False):
+    '''
+    Read and filter input records
+    njobs     : threads mapping reads to region/flank sequences
+    threads   : bgzf threads for reading bam input
+    subsample : seeded reservoir sample of n passing reads. Only sampled
+                sequences are kept
+    orient    : reverse complement reads on the opposite strand to the
+                median-length read, by minimizer vote (see orientSeqs)
+    returns dataframe of passing primary reads with qname,seq
     '''
     #Input generator
     if fileType == 'bam':
-        bam         = pysam.AlignmentFile(inFile,'rb')
-        if region:
-            if extractRef:
-                recGen = extractRegion(inFile,extractRef,region,flanksize=FLANKSIZE)
+        def records():
+            bam = pysam.AlignmentFile(inFile,'rb',threads=threads)
+            if region:
+                if extractRef:
+                    return extractRegion(inFile,extractRef,region,flanksize=FLANKSIZE,
+                                         nthreads=njobs,threads=threads)
+                else:
+                    return bam.fetch(*getCoordinates(region))
             else:
-                recGen = bam.fetch(*getCoordinates(region))
-        else:
-            recGen = bam
+                return bam
     elif fileType == 'fastq':
-        recGen = fastqReader(inFile) 
+        records = partial(fastqReader,inFile)
     else:
         raise Kmer_Exception('Invalid input type')
     #Filters
@@ -100,111 +240,412 @@ def loadKmers(inFile,qual,k,
         useRead = noFilter
     passQuality = qualityCrit(qual)
     lengthCrit  = getLengthCrit(minLength,maxLength)
-    flankCrit   = getFlankCrit(flanks) if flanks else noFilter
+    flankMapper = FlankMapper(flanks,nthreads=njobs) if flanks else None
+    def passing():
+        return (rec for rec in records()
+                if useRead(rec.query_name)
+                  and passQuality(rec)
+                  and lengthCrit(rec))
 
     print("Reading Sequence")
-    seqDB = pd.DataFrame([{'qname'   :rec.query_name,
-                           'seq'     :rec.query_sequence,
-                           'r_st'    :rec.reference_start,
-                           'r_en'    :rec.reference_end,
-                           'isSecond':bool(rec.flag & 0x900),
-                           'isrev'   :bool(rec.flag & 0x10)}
-                          for rec in recGen
-                          if useRead(rec.query_name) 
-                            and passQuality(rec)
-                            and lengthCrit(rec) 
-                            and flankCrit(rec)])    
-
-    if palfilter:
-        #filter out palindromic sequences
-        multiMapped = seqDB[seqDB.isSecond].qname
-        palindromes = seqDB.query('qname in @multiMapped')\
-                           .groupby('qname')\
-                           .filter(isArtifact)\
-                           .qname.unique()
-        sequences = seqDB.query('qname not in @palindromes and not isSecond')
+    #reads can only be sampled before loading when the input can be read twice
+    streamed = fileType == 'bam' and inFile == '-'
+    if subsample and not (palfilter and streamed):
+        candidates = set()
+        if palfilter and not extractRef:
+            #first pass on alignment metadata only. Extracted regions have no
+            #secondary/supplementary records, so no artifacts to find there
+            candidates = set(findArtifacts(pd.DataFrame(map(alignmentMeta,passing()),
+                                                        columns=ALNMETA)))
+        reads = (rec for rec in passing()
+                 if not (rec.flag & 0x900) or rec.query_name in candidates)
+        if flankMapper:
+            reads = flankMapper.filterReads(reads)
+        def sampled():
+            held = []
+            for rec in reads:
+                if rec.query_name in candidates:
+                    held.append(dict(alignmentMeta(rec),seq=rec.query_sequence))
+                elif not (rec.flag & 0x900):
+                    yield rec.query_name,rec.query_sequence
+            #candidates are artifacts only if their flank-passing alignments still are
+            held = pd.DataFrame(held,columns=ALNMETA+['seq'])
+            palindromes = findArtifacts(held) if len(held) else []
+            kept = held.query('qname not in @palindromes and not isSecond')
+            yield from kept[['qname','seq']].itertuples(index=False,name=None)
+        sample,total = reservoirSample(sampled(),subsample,randseed=randseed)
+        if total > subsample:
+            print(f"Downsampled to {subsample} reads from {total}")
+        sequences = pd.DataFrame(sample,columns=['qname','seq'])
     else:
-        #just remove secondary/supplemental alignments
-        sequences = seqDB.query('not isSecond')
+        seqDB = pd.DataFrame([dict(alignmentMeta(rec),seq=rec.query_sequence)
+                              for rec in passing()],
+                             columns=ALNMETA+['seq'])
+
+        if flankMapper and len(seqDB):
+            #all reads are mapped to one shared index of the flanks
+            seqDB = seqDB[flankMapper.hasFlanks(seqDB.seq)]
+
+        if palfilter:
+            #filter out palindromic sequences
+            palindromes = findArtifacts(seqDB)
+            sequences   = seqDB.query('qname not in @palindromes and not isSecond')
+        else:
+            #just remove secondary/supplemental alignments
+            sequences = seqDB.query('not isSecond')
+
+        if subsample and len(sequences) > subsample:
+            print(f"Downsampling to {subsample} reads from {len(sequences)}")
+            sequences = sequences.sample(subsample,replace=False,random_state=randseed)
 
     if len(sequences) == 0:
         raise Kmer_Exception('No sequences returned for clustering!')
 
-    if subsample and len(sequences) > subsample:
-        print(f"Downsampling to {subsample} reads from {len(sequences)}")
-        sequences = sequences.sample(subsample,replace=False,random_state=randseed)
+    sequences = sequences[['qname','seq']]
+    if orient:
+        flip      = orientSeqs(sequences.seq.tolist())
+        sequences = sequences.assign(seq=[revcompSeq(s) if f else s
+                                          for s,f in zip(sequences.seq,flip)])
+        print(f'Oriented {flip.sum()} of {len(sequences)} reads to the reverse strand')
 
-    counts    = defaultdict(lambda: np.zeros(len(sequences),dtype=np.int16))
-    parser    = seqParser(k,collapseHP=collapse,
-                          minimizer=minimizer,
-                          ignoreEnds=ignoreEnds)
-    for i,seq in enumerate(sequences.seq):
-        for kmer in parser(seq):
-            counts[kmer][i] +=1
+    return sequences
 
-    data = pd.DataFrame(np.array(list(counts.values())).T,
-                        index=sequences.qname)
+def alignmentMeta(rec):
+    '''alignment fields used by the artifact filter'''
+    return {'qname'   :rec.query_name,
+            'r_st'    :rec.reference_start,
+            'r_en'    :rec.reference_end,
+            'isSecond':bool(rec.flag & 0x900),
+            'isrev'   :bool(rec.flag & 0x10)}
+
+def reservoirSample(items,n,randseed=RANDSEED):
+    '''
+    Seeded uniform sample of n items from an iterable in one pass (Algorithm L).
+    Items between replacements are skipped without being stored.
+    returns (sample,total): sampled items in input order and number of items seen
+    '''
+    rng    = random.Random(randseed)
+    seen   = [0]
+    def tally():
+        for seen[0],item in enumerate(items,1):
+            yield item
+    stream = enumerate(tally())
+    sample = list(islice(stream,n))
+    if len(sample) == n and n > 0:
+        w = math.exp(math.log(rng.random())/n)
+        while True:
+            skip = int(math.log(rng.random())/math.log(1-w))
+            item = next(islice(stream,skip,None),None)
+            if item is None:
+                break
+            sample[rng.randrange(n)] = item
+            w *= math.exp(math.log(rng.random())/n)
+    return [item for _,item in sorted(sample,key=lambda x:x[0])],seen[0]
+
+def countTable(sequences,parser,trim,discover=0,randseed=RANDSEED,njobs=1):
+    '''
+    Count and trim kmers
+    returns (counts,names,kmers,lengths): sparse reads x kmers counts, read names, 
+            kmer string of each column and read lengths
+    '''
+    if discover and trim != [0,1] and len(sequences) > discover:
+        #first pass on a subsample finds kmers in the trim window
+        print(f"Discovering informative kmers in {discover} reads")
+        sample         = sequences.seq.sample(discover,replace=False,random_state=randseed)
+        scounts,skeys  = countKmers(sample.values,parser,njobs=njobs)
+        parser.allowed = np.sort(skeys[trimMask(scounts,trim)])
+        print(f"Counting {len(parser.allowed)} kmers in all reads")
+    counts,keys = countKmers(sequences.seq.values,parser,njobs=njobs)
 
     if trim != [0,1]:
         #print("Trimming low-freq kmers")
         print(f"Trimming kmers top,bottom {trim}")
-        freqs = (data!=0).sum()/len(data)
-        #data  = data.loc[:,freqs>=trim] 
-        data  = data.loc[:,(freqs>=trim[0]) & (freqs<=trim[1])] 
+        use    = trimMask(counts,trim)
+        counts = counts[:,use]
+        keys   = keys[use]
+
+    kmers = np.array([parser.decode(key) for key in keys],dtype=str)
+    return counts,sequences.qname.values,kmers,sequences.seq.str.len().values
 
-    col2kmer = dict(enumerate(counts.keys()))
-    if exportKmers:
-        print('Exporting kmer counts')
-        data.rename(columns=col2kmer).to_csv(exportKmers)
+def exportTable(fname,counts,names,kmers,lengths=None):
+    '''write reads x kmers counts to npz (see saveKmerTable) or, for other extensions, dense csv'''
+    print('Exporting kmer counts')
+    if fname.endswith('.npz'):
+        saveKmerTable(fname,counts,names,kmers,lengths)
+    else:
+        pd.DataFrame(counts.toarray(),index=pd.Index(names,name='qname'),columns=kmers)\
+          .to_csv(fname)
+    return fname
+
+def transformTable(counts,names,kmers,norm=None,
+                   components=3,agg='pca',
+                   randseed=RANDSEED,dedup=False):
+    '''
+    Normalize and reduce kmer counts
+    dedup  : return only the first read of each unique kmer profile
+    returns (data,dups): dataframe of reads x components (or x kmers if components == 0)
+            and the DuplicateReads mapping of its rows to all reads (None without dedup)
+    '''
+    names = pd.Index(names,name='qname')
+    dups  = DuplicateReads(counts,names) if dedup else None
 
     if norm:
         print('Normalizing data')
-        data = pd.DataFrame(normalize(data,norm=norm),
-                            index=data.index,
-                            columns=data.columns)
+        counts = normalize(counts,norm=norm)
     if components:
         print(f'Reducing Features with {agg}')
-        if agg == 'pca':
-            tool = PCA(n_components=components)
-        elif agg == 'featagg':
-            tool = FeatureAgglomeration(n_clusters=components)
-        else:
-            raise Kmer_Exception(f'{agg} is not a valid reduction tool')
         try:
-            data = pd.DataFrame(tool.fit_transform(data),
-                                index=data.index)
+            data = pd.DataFrame(reduceFeatures(counts,components,agg,
+                                               randseed=randseed),
+                                index=names)
         except ValueError as e:
             #catch errors in reduction
             raise Kmer_Exception(f'Too few datapoints: {e}')
+    else:
+        data = pd.DataFrame(counts.toarray(),index=names,columns=kmers)
 
-    return data.rename(columns=col2kmer)
+    if dups:
+        print(f'Collapsed {len(names)} reads to {len(dups.first)} unique kmer profiles')
+        data = data.iloc[dups.first]
+    return data,dups
 
-def hpCollapse(maxLen=2):
-    def csgen(sequence):
-        last = None
-        for char in sequence:
-            if char == last:
-                n += 1
-            else:
-                last = char
-                n    = 0
-            if n < maxLen:
-                yield char
-    return lambda seq: ''.join(csgen(seq))
+def trimMask(counts,trim):
+    '''columns of a reads x kmers matrix with read frequency in the trim window'''
+    freqs = counts.getnnz(axis=0)/counts.shape[0]
+    return (freqs>=trim[0]) & (freqs<=trim[1])
+
+def reduceFeatures(counts,components,agg='pca',maxMB=DENSEMB,randseed=RANDSEED):
+    '''
+    Reduce sparse reads x kmers matrix to dense reads x components
+    agg : pca     -> PCA (on the sparse matrix if sklearn supports it)
+          svd     -> randomized TruncatedSVD on the sparse matrix
+          ipca    -> IncrementalPCA fit and applied to dense batches of reads,
+                     each at most maxMB (and at least components reads)
+          featagg -> FeatureAgglomeration restricted to kmer k-NN connectivity.
+                     Needs the whole dense reads x kmers matrix
+    '''
+    if agg == 'pca':
+        #arpack needs components < min(reads,kmers)
+        if components < min(counts.shape):
+            try:
+                return PCA(n_components=components,svd_solver='arpack',
+                           random_state=randseed).fit_transform(counts)
+            except TypeError:
+                #sparse input to PCA needs sklearn>=1.4
+                solver = 'auto'
+        else:
+            solver = 'full'
+        return PCA(n_components=components,svd_solver=solver,
+                   random_state=randseed).fit_transform(counts.toarray())
+    elif agg == 'svd':
+        return TruncatedSVD(n_components=components,
+                            algorithm='randomized',
+                            random_state=randseed).fit_transform(counts)
+    elif agg == 'ipca':
+        #rows per batch from the memory budget; every batch needs at least n_components reads
+        rows    = max((maxMB << 20) // (8*max(counts.shape[1],1)),components)
+        nbatch  = max(counts.shape[0] // rows,1)
+        batches = np.array_split(np.arange(counts.shape[0]),nbatch)
+        tool    = IncrementalPCA(n_components=components)
+        for idx in batches:
+            tool.partial_fit(counts[idx].toarray())
+        return np.vstack([tool.transform(counts[idx].toarray()) for idx in batches])
+    elif agg == 'featagg':
+        nfeat = counts.shape[1]
+        conn  = kneighbors_graph(counts.T,min(AGGKNN,nfeat-1),include_self=False) if nfeat > 1 else None
+        return FeatureAgglomeration(n_clusters=components,
+                                    connectivity=conn).fit_transform(counts.toarray())
+    else:
+        raise Kmer_Exception(f'{agg} is not a valid reduction tool')
+
+def countKmers(sequences,parser,chunksize=CHUNKSIZE,njobs=1):
+    '''
+    Count integer-coded kmers in each sequence
+    njobs  : count batches of reads in n worker processes (-1 for all cpus)
+    returns (counts,keys): sparse CSR reads x kmers counts and the parser key
+            of each column. Columns are ordered by first appearance
+    '''
+    nproc     = cpu_count() if njobs == -1 else max(njobs or 1,1)
+    chunksize = max(min(chunksize,-(-len(sequences)//nproc)),1)
+    starts    = range(0,len(sequences),chunksize)
+    chunks    = (sequences[i:i+chunksize] for i in starts)
+    if nproc > 1:
+        print(f'Counting kmers with {nproc} processes')
+        with Pool(nproc) as pool:
+            blocks = collectBlocks(parser,starts,pool.imap(partial(countBlock,parser),chunks))
+    else:
+        blocks = collectBlocks(parser,starts,map(partial(countBlock,parser),chunks))
+    return mergeBlocks(blocks,len(sequences),width=parser.nFeatures)
+
+def collectBlocks(parser,starts,results):
+    '''offset rows and register non-ACGT kmers of each counted block, in read order'''
+    blocks = []
+    for i,(rows,keys,cnts,vocab,extras) in zip(starts,results):
+        keys,vocab = parser.register(keys,extras),parser.register(vocab,extras)
+        if extras and parser.allowed is not None:
+            use            = parser.isAllowed(keys)
+            rows,keys,cnts = rows[use],keys[use],cnts[use]
+            vocab          = vocab[parser.isAllowed(vocab)]
+        blocks.append((rows + i,keys,cnts,vocab))
+    return blocks
+
+def countBlock(parser,seqs):
+    '''
+    Encode and count one batch of reads
+    returns (rows,keys,counts,vocab,extras): one entry per distinct read/kmer
+            pair, plus the batch kmer keys in order of first appearance
+    '''
+    rows,keys,extras = parser.encode(seqs)
+    if parser.nFeatures:
+        keys,sign    = parser.hash(keys,extras)
+        extras       = []
+    else:
+        sign         = None
+    if parser.allowed is not None:
+        #placeholders of non-ACGT kmers are checked after register
+        use          = (keys < 0) | parser.isAllowed(keys)
+        rows,keys    = rows[use],keys[use]
+        sign         = sign[use] if sign is not None else None
+    uniq,first,inv   = np.unique(keys,return_index=True,return_inverse=True)
+    vocab            = uniq[np.argsort(first)]
+    pairs,pinv       = np.unique(rows*len(uniq) + inv.ravel(),return_inverse=True)
+    cnts             = np.bincount(pinv.ravel(),weights=sign,minlength=len(pairs))
+    return pairs//len(uniq),uniq[pairs%len(uniq)],cnts.astype(np.int16),vocab,extras
+
+def mergeBlocks(blocks,nreads,width=0):
+    '''
+    Merge counted blocks into one CSR matrix with global column ids
+    width : fixed number of columns for hashed keys (key == column)
+    '''
+    if not blocks:
+        return sparse.csr_matrix((nreads,width),dtype=np.int16),np.arange(width)
+    rows,keys,cnts,vocab = map(np.concatenate,zip(*blocks))
+    if width:
+        counts = sparse.csr_matrix((cnts,(rows,keys)),shape=(nreads,width))
+        #signed collisions can cancel out
+        counts.eliminate_zeros()
+        return counts,np.arange(width)
+    uniq,first  = np.unique(vocab,return_index=True)
+    order       = np.argsort(first)
+    rank        = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    cols        = rank[np.searchsorted(uniq,keys)]
+    #duplicate pairs (register can merge keys) are summed on conversion
+    counts      = sparse.csr_matrix((cnts,(rows,cols)),shape=(nreads,len(uniq)))
+    return counts,uniq[order]
 
 class seqParser:
-    def __init__(self,k=11,collapseHP=1,minimizer=0,ignoreEnds=0):
+    def __init__(self,k=11,collapseHP=1,minimizer=0,ignoreEnds=0,nFeatures=0,canonical=False):
+        self._args     = (k,collapseHP,minimizer,ignoreEnds,nFeatures,canonical)
         self.k         = k
         #self.transform = hpCollapse if collapseHP else ident
         self.transform = hpCollapse(collapseHP) if collapseHP >= 1 else ident
+        self.maxHP     = collapseHP
+        self.canonical = canonical #kmer and its reverse complement are one feature
+        self.canon     = canonicalKmer if canonical else ident
         #self.minim     = getMinimizer(minimizer) if minimizer>0 else ident
-        self.minim     = self.getMinimizer(minimizer) if minimizer>0 else ident
+        self.minim     = self.getMinimizer(minimizer) if minimizer>0 else self.canon
         self.start     = ignoreEnds
         self.end       = -ignoreEnds if ignoreEnds else 1000000 #really big to get everything
+        if minimizer > k:
+            raise Kmer_Exception(f'Minimizer ({minimizer}) cannot be longer than kmer ({k})')
+        self.m         = minimizer
+        self.size      = minimizer if minimizer>0 else k #length of output features
+        #keys >= offset index non-ACGT features, which have no 2-bit code
+        self.offset    = 4**self.size if self.size <= MAXCODEK else 0
+        self.extra     = {}
+        self.extraKmers= []
+        self.nFeatures = nFeatures #hash kmers into n buckets (0 = exact kmers)
+        self.allowed   = None      #sorted keys to count (None = all)
+    def __reduce__(self):
+        #transforms are closures; rebuild from settings when sent to workers
+        return (seqParser,self._args,{'allowed':self.allowed})
     def __call__(self, seq):
         s = self.transform(seq[self.start:self.end])
         for i in range(len(s)-self.k+1):
             yield self.minim(s[i:i+self.k])
+    def encode(self,seqs):
+        '''
+        Integer-coded kmers for a batch of sequences.
+        returns (rows,keys,extras): read index and feature key of every kmer.
+                Kmers with non-ACGT bases fall back to string features and
+                get placeholder key -(j+1) for extras[j] (see register)
+        '''
+        seqs   = [seq[self.start:self.end] for seq in seqs]
+        lens   = np.fromiter(map(len,seqs),dtype=np.int64,count=len(seqs))
+        buf    = seqBytes(''.join(seqs))
+        rowOf  = np.repeat(np.arange(len(seqs)),lens)
+        if self.maxHP >= 1:
+            #collapse whole batch at once, runs restart at each read
+            keepHP = hpMask(buf,self.maxHP,breaks=np.cumsum(lens)-lens)
+            buf    = buf[keepHP]
+            rowOf  = rowOf[keepHP]
+        codes  = encodeSeq(buf)
+        n      = len(codes) - self.k + 1
+        if n <= 0:
+            return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64),[]
+        keep   = np.flatnonzero(rowOf[:n] == rowOf[self.k-1:]) #windows within one read
+        ambig  = windowCount(codes==AMBIG,self.k)[keep] > 0
+        if self.size > MAXCODEK:
+            keys  = np.zeros(len(keep),dtype=np.int64)
+            ambig = np.ones(len(keep),dtype=bool)
+        elif self.m:
+            #minimizer of each kmer is the min m-mer code in its window
+            mcodes = canonicalCodes(codes,self.m) if self.canonical else kmerCodes(codes,self.m)
+            keys   = slidingMin(mcodes,self.k-self.m+1)[keep]
+        else:
+            keys   = (canonicalCodes(codes,self.k) if self.canonical else kmerCodes(codes,self.k))[keep]
+        rows   = rowOf[keep]
+        amb    = np.flatnonzero(ambig)
+        extras = []
+        for i in amb:
+            extras.append(self.minim(buf[keep[i]:keep[i]+self.k].tobytes().decode()))
+        keys[amb] = -1 - np.arange(len(amb))
+        return rows,keys,extras
+    def register(self,keys,extras):
+        '''swap placeholder keys from encode for keys persistent in this parser'''
+        if extras:
+            for kmer in extras:
+                if kmer not in self.extra:
+                    #minimizers of non-ACGT kmers can still be plain ACGT
+                    code = kmerCode(kmer) if len(kmer) == self.size else None
+                    if code is None:
+                        code = self.offset + len(self.extraKmers)
+                        self.extraKmers.append(kmer)
+                    self.extra[kmer] = code
+            ids  = np.array([self.extra[kmer] for kmer in extras],dtype=np.int64)
+            mask = keys < 0
+            keys[mask] = ids[-keys[mask]-1]
+        return keys
+    def hash(self,keys,extras):
+        '''
+        Signed hash of encoded keys into nFeatures buckets
+        returns (bucket,sign)
+        '''
+        return hashCodes(self.stableKeys(keys,extras),self.nFeatures)
+    def stableKeys(self,keys,extras):
+        '''
+        Encoded keys with placeholders of non-ACGT kmers swapped for stable
+        string keys, so keys do not depend on read order
+        '''
+        if extras:
+            ids  = np.array([kmerCode(kmer) if len(kmer) == self.size and kmerCode(kmer) is not None
+                             else stringKey(kmer) for kmer in extras],dtype=np.int64)
+            keys = keys.copy()
+            mask = keys < 0
+            keys[mask] = ids[-keys[mask]-1]
+        return keys
+    def isAllowed(self,keys):
+        '''membership of keys in the sorted allowed set'''
+        pos = np.searchsorted(self.allowed,keys).clip(max=max(len(self.allowed)-1,0))
+        return (self.allowed[pos] == keys) if len(self.allowed) else np.zeros(len(keys),dtype=bool)
+    def decode(self,key):
+        '''kmer (or minimizer) string for a feature key'''
+        if self.nFeatures:
+            return f'hash{key}'
+        if key < self.offset:
+            return decodeKmer(key,self.size)
+        return self.extraKmers[key-self.offset]
     #def hpCollapse(self,maxLen=1):
     #    def csgen(sequence):
     #        last = None
@@ -219,9 +660,31 @@ class seqParser:
     #    return lambda seq: ''.join(csgen(seq))
     def getMinimizer(self,m=6):
         def minimizer(seq):
-            return sorted(seq[i:i+m] for i in range(0,len(seq)-m+1))[0]
+            return min(self.canon(seq[i:i+m]) for i in range(0,len(seq)-m+1))
         return minimizer
 
+class DuplicateReads:
+    '''
+    Groups of reads with identical (trimmed) kmer count rows, ie identical
+    reads after HP-collapse, which every model sees as one point.
+    Reduction still runs on all reads; clustering can run on the first read
+    of each group weighted by group size and broadcast labels back.
+    '''
+    def __init__(self,counts,names):
+        counts = sparse.csr_matrix(counts)
+        counts.sort_indices()
+        ptr    = counts.indptr
+        digest = [hashlib.blake2b(counts.indices[s:e].tobytes() + counts.data[s:e].tobytes(),
+                                  digest_size=16).digest()
+                  for s,e in zip(ptr[:-1],ptr[1:])]
+        self.inverse,_ = pd.factorize(pd.Series(digest)) #group of each read
+        self.first     = np.unique(self.inverse,return_index=True)[1]
+        self.weight    = np.bincount(self.inverse)
+        self.names     = names
+    def expand(self,labels):
+        '''labels of unique rows -> labels of every read'''
+        return np.asarray(labels)[self.inverse]
+
 class Kmer_Exception(Exception):
     pass
 
@@ -3,11 +3,23 @@ from sklearn.cluster import DBSCAN,\
                             AgglomerativeClustering, \
                             AffinityPropagation, \
                             KMeans, \
-                            MeanShift
+                            MeanShift, \
+                            MiniBatchKMeans, \
+                            Birch
+from sklearn.neighbors import NearestNeighbors
+from .graph import KnnAgglomerative, \
+                   SparseAffinityPropagation, \
+                   KnnLouvain, \
+                   MUTUALKNN
 import numpy as np
-from collections import Counter
+import pandas as pd
+from scipy import sparse
+from itertools import repeat
+from inspect import signature
 import json
 
+BATCHSIZE=10000 #reads per partial_fit batch for streaming models
+
 class ClusterModel:
     '''
     defaults: { modelKwargs     : defaultValue }
@@ -31,8 +43,15 @@ class ClusterModel:
                 config = json.load(configFile)
             self.defaults.update(config)
         self.model = self.MODEL(**self.defaults)
-    def fit(self,X):
-        return self.model.fit(X)
+    def fit(self,X,sampleWeight=None):
+        return self.model.fit(X,**self._weights(sampleWeight))
+    def _weights(self,sampleWeight,method='fit'):
+        '''sample_weight kwarg, for models that accept it'''
+        if sampleWeight is None:
+            return {}
+        if 'sample_weight' not in signature(getattr(self.MODEL,method)).parameters:
+            raise Clustering_Exception(f'{self.MODEL.__name__} does not take sample weights (--dedup)')
+        return {'sample_weight':sampleWeight}
     def __repr__(self):
         name          = self.MODEL.__name__
         dashes        = ''.join(['-']*((40 - len(name)) // 2))
@@ -45,19 +64,44 @@ class ClusterModel_wNoise(ClusterModel):
     '''
     Subclass for models without a min cluster size.
     Re-labels small clusters < minReads to noise (-1)
+    Cluster size is the sum of sample weights (read counts of collapsed duplicates)
     '''
     def __init__(self,args):
         self.minCnt = args.minReads
         self._noiseLabels = []
         super().__init__(args)
-    def fit(self,X):
-        res = self.model.fit(X)
-        for val,count in Counter(res.labels_).items():
+    def fit(self,X,sampleWeight=None):
+        return self._relabel(self.model.fit(X,**self._weights(sampleWeight)),sampleWeight)
+    def _relabel(self,res,sampleWeight=None):
+        weight = np.ones(len(res.labels_)) if sampleWeight is None else np.asarray(sampleWeight)
+        for val,count in pd.Series(weight).groupby(res.labels_).sum().items():
             if count < self.minCnt:
                 self._noiseLabels.extend(np.where(res.labels_==val)[0])
                 res.labels_[res.labels_==val] = -1
         return res
 
+class ClusterModel_Stream(ClusterModel_wNoise):
+    '''
+    Subclass for models with partial_fit.
+    Fit and labeled over batches of reads so only one batch is needed at a
+    time; fitBatches accepts any iterable of batches (eg streamed features)
+    '''
+    batchSize = BATCHSIZE
+    def fit(self,X,sampleWeight=None):
+        weights = None if sampleWeight is None else self._batches(np.asarray(sampleWeight))
+        self.fitBatches(self._batches(X),weights)
+        self.model.labels_ = np.concatenate([self.model.predict(b) 
+                                             for b in self._batches(X)])
+        return self._relabel(self.model,sampleWeight)
+    def fitBatches(self,batches,weights=None):
+        if weights is None:
+            weights = repeat(None)
+        for batch,weight in zip(batches,weights):
+            self.model.partial_fit(batch,**self._weights(weight,'partial_fit'))
+        return self.model
+    def _batches(self,X):
+        return (X[i:i+self.batchSize] for i in range(0,len(X),self.batchSize))
+
 class Dbscan(ClusterModel):
     MODEL    = DBSCAN
     defaults = {'eps'        : 0.01,
@@ -110,6 +154,52 @@ class Affprop(ClusterModel_wNoise):
     #        raise Clustering_Exception('Damping (-e) must be in [0.5-1] for AffinityPropagation')
     #    super().__init__(args)
 
+class MiniBatchKmeans(ClusterModel_Stream):
+    '''trained only with partial_fit: batch size is BATCHSIZE and there is no eps/tol'''
+    MODEL    = MiniBatchKMeans
+    defaults = {'n_clusters'  : 2,
+                'random_state': None}
+    pmap     = {'seed'        : 'random_state'}
+
+class Birchcluster(ClusterModel_Stream):
+    MODEL    = Birch
+    defaults = {'threshold'       : 0.01,
+                'branching_factor': 50,
+                'n_clusters'      : None} #subclusters are clusters
+    pmap     = {'eps'             : 'threshold'}
+
+class KnnAggcluster(ClusterModel_wNoise):
+    '''Aggcluster merging only along a sparse k-NN graph of reads'''
+    MODEL    = KnnAgglomerative
+    defaults = {'n_neighbors'       : 10,
+                'linkage'           : 'ward',
+                'distance_threshold': 0.01,
+                'n_clusters'        : None,
+                'n_jobs'            : 1}
+    pmap     = {'eps'  : 'distance_threshold',
+                'njobs': 'n_jobs'}
+
+class KnnAffprop(ClusterModel_wNoise):
+    '''Affprop with similarities only between k-NN graph neighbors'''
+    MODEL    = SparseAffinityPropagation
+    defaults = {'n_neighbors' : 30,
+                'preference'  : None, #median of inputs
+                'damping'     : 0.5,
+                'random_state': 0,
+                'n_jobs'      : 1}
+    pmap     = {'eps'  : 'preference',
+                'njobs': 'n_jobs'}
+
+class Knnlouvain(ClusterModel_wNoise):
+    '''Louvain communities of the mutual k-NN graph, no eps needed'''
+    MODEL    = KnnLouvain
+    defaults = {'n_neighbors' : MUTUALKNN,
+                'resolution'  : 1.0,
+                'random_state': 0,
+                'n_jobs'      : 1}
+    pmap     = {'seed' : 'random_state',
+                'njobs': 'n_jobs'}
+
 class Meanshift(ClusterModel):
     MODEL    = MeanShift
     defaults = {'bandwidth'   : None, #estimate from data
@@ -126,7 +216,88 @@ MODELS = {'dbscan'    : Dbscan,
           'aggcluster': Aggcluster,
           'affprop'   : Affprop,
           'meanshift' : Meanshift,
-          'kmeans'    : Kmeans}
+          'kmeans'    : Kmeans,
+          'knnagg'    : KnnAggcluster,
+          'knnaffprop': KnnAffprop,
+          'mbkmeans'  : MiniBatchKmeans,
+          'birch'     : Birchcluster,
+          'knnlouvain': Knnlouvain}
+
+def assignNearest(model,Xfit,labels,X,maxDist=None,njobs=None):
+    '''
+    Label rows of X by the nearest reference point of a model fit on Xfit.
+    References are core samples (dbscan), exemplars or centroids when the
+    model has them, otherwise every clustered read of the fit.  Reads farther
+    than maxDist from all references are noise (-1); core-sample models
+    default maxDist to their eps.
+    '''
+    Xfit,X = np.asarray(Xfit),np.asarray(X)
+    labels = np.asarray(labels)
+    if len(getattr(model,'core_sample_indices_',[])):
+        idx     = model.core_sample_indices_
+        refs,refLabels = Xfit[idx],labels[idx]
+        maxDist = maxDist or getattr(model,'eps',None)
+    elif len(getattr(model,'cluster_centers_indices_',[])):
+        idx     = model.cluster_centers_indices_
+        refs,refLabels = Xfit[idx],np.arange(len(idx))
+    elif len(getattr(model,'cluster_centers_',[])):
+        refs,refLabels = np.asarray(model.cluster_centers_),np.arange(len(model.cluster_centers_))
+    else:
+        refs,refLabels = Xfit,labels
+    #drop references of clusters relabeled as noise
+    keep = np.isin(refLabels,labels[labels != -1])
+    refs,refLabels = refs[keep],refLabels[keep]
+    if len(refs) == 0:
+        return np.full(len(X),-1)
+    nn        = NearestNeighbors(n_neighbors=1,algorithm='ball_tree',n_jobs=njobs).fit(refs)
+    dist,near = nn.kneighbors(X)
+    assigned  = refLabels[near[:,0]]
+    if maxDist:
+        assigned[dist[:,0] > maxDist] = -1
+    return assigned
+
+def dbscanSweep(X,epsGrid,minReadsGrid,njobs=1,sampleWeight=None):
+    '''
+    DBSCAN over a grid of eps x minReads from one radius neighbor graph.
+    The graph is built once with a tree index at the largest eps; each setting
+    clusters the graph restricted to distances <= eps with metric='precomputed'.
+    X           : reads x features, or a sparse reads x reads distance graph
+    sampleWeight: read count of each row (collapsed duplicates)
+    returns dataframe with one row of cluster counts/sizes/noise per setting
+    '''
+    weight = np.ones(X.shape[0],dtype=int) if sampleWeight is None else np.asarray(sampleWeight)
+    if sparse.issparse(X):
+        #precomputed distance graph, eg MinHash sketches
+        graph = sparse.csr_matrix(X)
+    else:
+        graph = NearestNeighbors(radius=max(epsGrid),n_jobs=njobs)\
+                  .fit(X)\
+                  .radius_neighbors_graph(mode='distance')
+    rows  = []
+    for eps in sorted(epsGrid):
+        sub = radiusSubgraph(graph,eps)
+        for minReads in sorted(minReadsGrid):
+            labels = DBSCAN(eps=eps,min_samples=minReads,
+                            metric='precomputed',n_jobs=njobs).fit(sub,sample_weight=sampleWeight).labels_
+            sizes  = sorted(pd.Series(weight[labels != -1]).groupby(labels[labels != -1]).sum(),reverse=True)
+            noise  = int(weight[labels == -1].sum())
+            rows.append({'eps'      : eps,
+                         'minReads' : minReads,
+                         'nclusters': len(sizes),
+                         'noise'    : noise,
+                         'noiseFrac': noise / weight.sum(),
+                         'sizes'    : ','.join(map(str,sizes))})
+    return pd.DataFrame(rows)
+
+def radiusSubgraph(graph,eps):
+    '''
+    Entries of a CSR distance graph within eps. Zero distances (identical
+    reads) are explicit entries, so entries are masked rather than eliminated
+    '''
+    keep   = graph.data <= eps
+    rows   = np.repeat(np.arange(graph.shape[0]),np.diff(graph.indptr))
+    indptr = np.concatenate([[0],np.cumsum(np.bincount(rows[keep],minlength=graph.shape[0]))])
+    return sparse.csr_matrix((graph.data[keep],graph.indices[keep],indptr),shape=graph.shape)
 
 def showModels(args):
     models = [MODELS[args.model]] if args.model else MODELS.values()
@@ -0,0 +1,69 @@
+import numpy as np
+
+VALLEYFRAC=0.5   #max valley/peak density ratio separating two length modes
+BWFRAC    =0.002 #default smoothing bandwidth as fraction of median length
+
+def lengthModes(lengths,bandwidth=0,minReads=1,valley=VALLEYFRAC):
+    '''
+    Modes of the read-length distribution.
+    Lengths are counted at 1bp and smoothed with a gaussian of sd bandwidth
+    (default BWFRAC x median length).  Neighboring modes are split at the
+    density minimum between them if it is below valley x the smaller peak,
+    and bins with fewer than minReads reads are merged into a neighbor.
+    returns (modes,bounds): mode lengths and the len(modes)-1 lengths between
+            bins; a read of length >= bounds[i] falls in bin i+1
+    '''
+    lengths = np.asarray(lengths,dtype=int)
+    bw      = bandwidth or max(2,BWFRAC*np.median(lengths))
+    half    = int(np.ceil(4*bw))
+    lo      = lengths.min() - half
+    hist    = np.bincount(lengths - lo,minlength=lengths.max() - lo + half + 1)
+    offsets = np.arange(-half,half+1)
+    dens    = np.convolve(hist,np.exp(-0.5*(offsets/bw)**2),mode='same')
+
+    inner   = np.arange(1,len(dens)-1)
+    peaks   = inner[(dens[inner] > dens[inner-1]) & (dens[inner] >= dens[inner+1])]
+    #merge shallow valleys, least separated pair first
+    while len(peaks) > 1:
+        valleys = _valleys(dens,peaks)
+        ratio   = dens[valleys] / np.minimum(dens[peaks[:-1]],dens[peaks[1:]])
+        i       = np.argmax(ratio)
+        if ratio[i] < valley:
+            break
+        peaks   = np.delete(peaks,i if dens[peaks[i]] < dens[peaks[i+1]] else i+1)
+    #merge small bins into the neighbor across the higher valley
+    while len(peaks) > 1:
+        valleys = _valleys(dens,peaks)
+        counts  = np.bincount(np.searchsorted(valleys + lo,lengths,side='right'),
+                              minlength=len(peaks))
+        j       = np.argmin(counts)
+        if counts[j] >= minReads:
+            break
+        if j == 0 or (j < len(peaks)-1 and dens[valleys[j]] > dens[valleys[j-1]]):
+            drop = j+1 if dens[peaks[j+1]] < dens[peaks[j]] else j
+        else:
+            drop = j-1 if dens[peaks[j-1]] < dens[peaks[j]] else j
+        peaks   = np.delete(peaks,drop)
+
+    valleys = _valleys(dens,peaks) if len(peaks) > 1 else np.array([],dtype=int)
+    return peaks + lo,valleys + lo
+
+def _valleys(dens,peaks):
+    '''position of min density between each pair of neighboring peaks'''
+    return np.array([a + np.argmin(dens[a:b+1]) for a,b in zip(peaks[:-1],peaks[1:])],dtype=int)
+
+def lengthBins(lengths,bounds,overlap=0):
+    '''
+    Bin of each read from lengthModes bounds.
+    returns (home,neighbor): neighbor is the bin across a boundary within
+            overlap bp of the read (-1 if none)
+    '''
+    lengths  = np.asarray(lengths)
+    home     = np.searchsorted(bounds,lengths,side='right')
+    neighbor = np.full(len(lengths),-1)
+    if overlap:
+        for i,bound in enumerate(bounds):
+            near = np.abs(lengths - bound) <= overlap
+            neighbor[near & (home == i)]   = i + 1
+            neighbor[near & (home == i+1)] = i
+    return home,neighbor
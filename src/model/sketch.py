@@ -0,0 +1,113 @@
+import numpy as np
+from functools import partial
+from multiprocessing import Pool,cpu_count
+from scipy import sparse
+from ..utils.sequence import mix64
+
+SKETCHSIZE=256    #bottom-k hashes per read
+NBANDS    =16     #LSH bands
+BANDROWS  =4      #sketch hashes per band
+BANDLINKS =10     #pairs per read and band within an LSH bucket
+PAIRCHUNK =20000  #pairs per distance batch
+READCHUNK =1000   #reads sketched per batch
+EMPTY     =np.iinfo(np.uint64).max #padding of sketches with < size kmers
+
+def sketchReads(sequences,parser,size=SKETCHSIZE,chunksize=READCHUNK,njobs=1):
+    '''
+    Bottom-k MinHash sketches of the seqParser kmers of each read
+    njobs  : sketch batches of reads in n worker processes (-1 for all cpus)
+    returns reads x size uint64 array of sorted kmer hashes, padded with EMPTY
+    '''
+    nproc  = cpu_count() if njobs == -1 else max(njobs or 1,1)
+    chunks = (sequences[i:i+chunksize] for i in range(0,len(sequences),chunksize))
+    if nproc > 1:
+        with Pool(nproc) as pool:
+            blocks = list(pool.imap(partial(sketchBlock,parser,size),chunks))
+    else:
+        blocks = list(map(partial(sketchBlock,parser,size),chunks))
+    return np.vstack(blocks) if blocks else np.zeros((0,size),dtype=np.uint64)
+
+def sketchBlock(parser,size,seqs):
+    '''bottom-k sketches of one batch of reads'''
+    rows,keys,extras = parser.encode(seqs)
+    hashes      = mix64(parser.stableKeys(keys,extras))
+    order       = np.lexsort((hashes,rows))
+    rows,hashes = rows[order],hashes[order]
+    uniq        = np.ones(len(rows),dtype=bool)
+    uniq[1:]    = (rows[1:] != rows[:-1]) | (hashes[1:] != hashes[:-1])
+    rows,hashes = rows[uniq],hashes[uniq]
+    rank        = np.arange(len(rows)) - np.searchsorted(rows,rows)
+    keep        = rank < size
+    sketches    = np.full((len(seqs),size),EMPTY,dtype=np.uint64)
+    sketches[rows[keep],rank[keep]] = hashes[keep]
+    return sketches
+
+def candidatePairs(sketches,bands=NBANDS,rows=BANDROWS,links=BANDLINKS,randseed=None):
+    '''
+    Read pairs sharing an LSH bucket in any band.
+    Band b holds the smallest `rows` hashes h of a sketch with h % bands == b,
+    ie a bottom-r sketch of a random 1/bands of the hash space, so reads
+    collide more often the higher their Jaccard similarity.  Reads in a bucket
+    are linked to the next `links` reads in random order, so buckets of
+    near-identical reads cost pairs linear in their size.
+    returns (i,j) unique pairs with i < j
+    '''
+    n       = len(sketches)
+    shuffle = np.random.RandomState(randseed).permutation(n)
+    band    = (sketches % np.uint64(bands)).astype(np.int64)
+    band[sketches == EMPTY] = -1
+    pairs   = []
+    for b in range(bands):
+        inBand = band == b
+        sel    = inBand & (np.cumsum(inBand,axis=1) <= rows)
+        full   = np.flatnonzero(sel.sum(axis=1) == rows)
+        if len(full) < 2:
+            continue
+        vals   = sketches[full][sel[full]].reshape(-1,rows)
+        key    = mix64(vals[:,0] ^ np.uint64(b))
+        for c in range(1,rows):
+            key = mix64(key ^ vals[:,c])
+        order  = np.lexsort((shuffle[full],key))
+        key,members = key[order],full[order]
+        for d in range(1,min(links,len(members)-1)+1):
+            same = key[d:] == key[:-d]
+            pairs.append(np.stack([members[:-d][same],members[d:][same]]))
+    if not pairs:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    i,j  = np.hstack(pairs)
+    code = np.unique(np.minimum(i,j)*n + np.maximum(i,j))
+    return code // n,code % n
+
+def sketchDistances(sketches,i,j,chunksize=PAIRCHUNK):
+    '''
+    Bottom-k estimate of Jaccard distance for each pair: the fraction of the
+    k smallest hashes of the union that are not in both reads
+    '''
+    size = sketches.shape[1]
+    dist = np.empty(len(i))
+    for s in range(0,len(i),chunksize):
+        both      = np.sort(np.hstack([sketches[i[s:s+chunksize]],sketches[j[s:s+chunksize]]]),axis=1)
+        valid     = both != EMPTY
+        dup       = np.zeros_like(valid)
+        dup[:,1:] = both[:,1:] == both[:,:-1]
+        uniq      = valid & ~dup
+        rank      = np.cumsum(uniq,axis=1) #rank in the union, shared by both copies
+        shared    = (dup & valid & (rank <= size)).sum(axis=1)
+        union     = np.minimum(uniq.sum(axis=1),size)
+        dist[s:s+chunksize] = 1 - shared / np.maximum(union,1)
+    return dist
+
+def sketchGraph(sketches,maxDist=1.0,randseed=None,**lshKwargs):
+    '''
+    Sparse symmetric reads x reads Jaccard distance graph over LSH candidate
+    pairs within maxDist.  Zero distances (identical kmer sets) are stored
+    explicitly so DBSCAN with metric='precomputed' counts them as neighbors
+    '''
+    n     = len(sketches)
+    i,j   = candidatePairs(sketches,randseed=randseed,**lshKwargs)
+    dist  = sketchDistances(sketches,i,j)
+    keep  = dist <= maxDist
+    i,j,dist = i[keep],j[keep],dist[keep]
+    return sparse.csr_matrix((np.concatenate([dist,dist]),
+                              (np.concatenate([i,j]),np.concatenate([j,i]))),
+                             shape=(n,n))
@@ -10,8 +10,10 @@ from collections import defaultdict
 from sklearn.cluster import SpectralClustering
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.utils.validation import check_symmetric
-from .utils import hpCollapse,RecordGenerator
+from .utils import RecordGenerator
+from ..utils.sequence import hpCollapse,orientSeqs,revcompSeq
 from ..utils.extract import getCoordinates
+from ..utils.bam import indexBam
 
 DIAGNOSTICS=False
 
@@ -25,7 +27,7 @@ class VariantGrouper:
                  hpmask=0,hptol=0,
                  vTable=None,nproc=1,prefix=None,
                  makeDf=None,log=None,stats={},
-                 diagnostics=DIAGNOSTICS):
+                 diagnostics=DIAGNOSTICS,threads=1):
         self.bamfile    = inFile             #bam file
         self.refFasta   = refFasta           #ref
         self.region     = region             #region eg X:12345-678900
@@ -41,6 +43,7 @@ class VariantGrouper:
         self.hpmask     = hpmask             #mask variants in homopolymers larger than this size; incl ins at beginning
         self.hptol      = hptol              #mask tolerance (added to hpmask on either side of each hp)
         self.nproc      = nproc
+        self.threads    = threads            #bgzf threads for bam io
         self.prefix     = prefix
         self.makeDf     = makeDf             #pickle-able function for parallel processing
         self.log        = log
@@ -102,8 +105,9 @@ class VariantGrouper:
         if self.log:
             self.log.info(f'Reading alignments from input BAM using {self.nproc} procs')
         if self.nproc == 1:
-            df  = self.makeDf(self.bamfile,self.refFasta,self.region,self.truncate)
-            bam = pysam.AlignmentFile(self.bamfile) 
+            df  = self.makeDf(self.bamfile,self.refFasta,self.region,self.truncate,
+                              threads=self.threads)
+            bam = pysam.AlignmentFile(self.bamfile,threads=self.threads) 
             self.stats['total alignments'] = bam.count()
             bam.reset()
             self.stats['primary alignments'] = sum(1 for r in bam if not r.flag & 0x900)
@@ -117,6 +121,7 @@ class VariantGrouper:
                 callback = self._chunkCallback(chunk,result)
                 pool.apply_async(self.makeDf,
                                  args=(chunk,self.refFasta),
+                                 kwds={'threads':self.threads},
                                  callback=callback) 
             pool.close()
             pool.join()
@@ -139,10 +144,10 @@ class VariantGrouper:
         oname  = outFmt.format(chunk)
         chunks = [oname]
         secNsup = 0
-        with pysam.AlignmentFile(self.bamfile) as inBam:
+        with pysam.AlignmentFile(self.bamfile,threads=self.threads) as inBam:
             nreads = inBam.count(region=self.region)
             breaks = np.linspace(0,nreads,self.nproc+1,dtype=int)[1:-1]
-            outBam = pysam.AlignmentFile(oname,'wb',template=inBam)
+            outBam = pysam.AlignmentFile(oname,'wb',template=inBam,threads=self.threads)
             for i,rec in enumerate(inBam.fetch(region=self.region)):
                 if rec.flag & 0x900:
                     secNsup += 1
@@ -150,14 +155,14 @@ class VariantGrouper:
                     outBam.write(rec)
                 if i in breaks:
                     outBam.close()
-                    pysam.index(oname)
+                    indexBam(oname,threads=self.threads)
                     yield oname
                     chunk += 1
                     oname = outFmt.format(chunk)
-                    outBam = pysam.AlignmentFile(oname,'wb',template=inBam)
+                    outBam = pysam.AlignmentFile(oname,'wb',template=inBam,threads=self.threads)
                     chunks.append(oname)
             outBam.close()
-            pysam.index(oname)
+            indexBam(oname,threads=self.threads)
             yield oname
             self.stats['total alignments'] = i+1
             self.stats['primary alignments'] = i+1 - secNsup
@@ -298,16 +303,29 @@ class sparseDBG:
     def __setitem__(self,key,item):
         self.nodes[key] = item
         
-    def loadReads(self,inFile,region=None,minLength=50,maxLength=50000):
-        recGen = RecordGenerator(inFile,minLength=minLength,maxLength=maxLength)
+    def loadReads(self,inFile,region=None,minLength=50,maxLength=50000,threads=1,
+                  orient=False,template='median'):
+        '''
+        orient   : reverse complement reads on the opposite strand to the
+                   template read (first or median length) before building the graph
+        '''
+        recGen = RecordGenerator(inFile,minLength=minLength,maxLength=maxLength,threads=threads)
         self.name2idx  = recGen.getNameIdx()
         self.readnames = list(self.name2idx.keys())
         nReads         = len(self.readnames)
         self.minCount  = max(ceil(self.minFrac*nReads),self.minReads)
         allNodes       = {}
+        records        = recGen
+        if orient:
+            records = list(recGen)
+            flip    = orientSeqs([rec.sequence for rec in records],template=template)
+            for rec in np.array(records,dtype=object)[flip]:
+                rec.sequence = revcompSeq(rec.sequence)
+            if self.log:
+                self.log.info(f'Oriented {flip.sum()} of {len(records)} reads to the reverse strand')
         if self.log:
             self.log.info('Building debruijn graph')
-        for i,rec in enumerate(recGen):
+        for i,rec in enumerate(records):
             for kmer in self.parser(rec.sequence):
                 nseq = kmer[:-1]
                 if nseq in allNodes:
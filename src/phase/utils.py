@@ -5,6 +5,8 @@ from itertools import chain
 from statistics import median
 from collections import Counter
 from scipy.stats import entropy
+from ..utils.sequence import hpCollapse
+from ..utils.bam import indexBam
 
 MINLEN=50
 MAXLEN=50000
@@ -81,29 +83,16 @@ def getFileType(fname):
     else:
         raise PhaseUtils_Error(f'unknown filetype extension: {ext}')
 
-def hpCollapse(maxLen=1):
-    def csgen(sequence):
-        last = None
-        for char in sequence:
-            if char == last:
-                n += 1
-            else:
-                last = char
-                n    = 0
-            if n < maxLen:
-                yield char
-    return lambda seq: ''.join(csgen(seq))
-
 def writeSimpleBED(chrm,start,stop,name,cov,filename,mode='w'):
     with open(filename,mode) as ofile:
         ofile.write('\t'.join(map(str,[chrm,start,stop,name,cov])) + '\n')
 
-def writeRegionBam(inBam,outBam,region):
-    with pysam.AlignmentFile(inBam) as ibam:
-        with pysam.AlignmentFile(outBam,'wb',template=ibam) as obam:
+def writeRegionBam(inBam,outBam,region,threads=1):
+    with pysam.AlignmentFile(inBam,threads=threads) as ibam:
+        with pysam.AlignmentFile(outBam,'wb',template=ibam,threads=threads) as obam:
             for rec in ibam.fetch(region=region):
                 obam.write(rec)
-    pysam.index(outBam)
+    indexBam(outBam,threads=threads)
     return outBam
 
 class SimpleRecord:
@@ -114,9 +103,10 @@ class SimpleRecord:
         return len(self.sequence)
 
 class RecordGenerator:
-    def __init__(self,inFile,fileType=None,region=None,minLength=MINLEN,maxLength=MAXLEN):
+    def __init__(self,inFile,fileType=None,region=None,minLength=MINLEN,maxLength=MAXLEN,threads=1):
         self.inFile    = inFile
         self.region    = region
+        self.threads   = threads
         self.minLen    = minLength
         self.maxLen    = maxLength
         
@@ -137,7 +127,7 @@ class RecordGenerator:
         return f'Alignments loaded: {self.counter["pass"]}; filtered: {other}'
 
     def _bamIter(self,bamfile,track=True,**kwargs):
-        bam = pysam.AlignmentFile(bamfile,check_sq=False)
+        bam = pysam.AlignmentFile(bamfile,check_sq=False,threads=self.threads)
         if kwargs['region']:
             recgen = bam.fetch(region=kwargs['region'])
         else:
@@ -201,10 +191,11 @@ class RecTracker:
 class PilerUpper:
     def __init__(self,inFile,region=None,refSeq=None,method='median',
                  minLength=50,maxLength=1e6,maxHP=1,log=None,
-                 multifunc=None,nproc=1):
+                 multifunc=None,nproc=1,threads=1):
         self.recGen    = RecordGenerator(inFile,region=region,
                                          minLength=minLength,
-                                         maxLength=maxLength)
+                                         maxLength=maxLength,
+                                         threads=threads)
         self.collapse  = hpCollapse(maxHP) if maxHP else (lambda x:x)
         self.log       = log
         self.nproc     = nproc
@@ -21,8 +21,9 @@ def addHPtag(args,outBAM,clusterMap,noCluster=NOCLUST):
     #noise
     colors[-1] = NOISECOLOR
     dropFilt   = args.drop
+    threads    = getattr(args,'threads',1)
 
-    with pysam.AlignmentFile(args.inBAM) as inbam:
+    with pysam.AlignmentFile(args.inBAM,threads=threads) as inbam:
         header = inbam.header.to_dict()
         header['PG'].append(getCL(args))
         if args.splitBam:
@@ -30,12 +31,12 @@ def addHPtag(args,outBAM,clusterMap,noCluster=NOCLUST):
                              f'.{"Noise" if c==-1 else str(c)}.bam',
                              outBAM)
                       for c in cvals ]
-            outMap = {c : pysam.AlignmentFile(n,'wb',header=header)
+            outMap = {c : pysam.AlignmentFile(n,'wb',header=header,threads=threads)
                       for c,n in zip(cvals,names)}
             dropFilt = True #no place to put these
         else:
             names  = [outBAM]
-            outbam = pysam.AlignmentFile(outBAM,'wb',header=header)
+            outbam = pysam.AlignmentFile(outBAM,'wb',header=header,threads=threads)
             outMap = {c:outbam for c in cvals.union([noCluster])}
         getbam = (lambda c: outMap[c])
         recGen = inbam.fetch(*getCoordinates(args.region)) if args.region else inbam
@@ -53,10 +54,14 @@ def addHPtag(args,outBAM,clusterMap,noCluster=NOCLUST):
             getbam(clust).write(rec)
     for b,n in zip(outMap.values(),names):
         b.close()
-        pysam.index(n)
+        indexBam(n,threads=threads)
 
     return None
 
+def indexBam(bamfile,threads=1):
+    '''samtools index using the same thread budget as pysam (-@ counts extra threads)'''
+    pysam.index('-@',str(max(threads-1,0)),bamfile)
+
 def getCL(args):
     baseProg = args.prog.split(' ')[0]
     cl = f'{args.prog} ' + ' '.join(f'--{a} {getattr(args,a)}' 
@@ -74,12 +79,12 @@ def stripReadname(readname):
     '''strip off all but <movie>/<zmw>/ccs'''
     return '/'.join(readname.split('/')[:3])
 
-def exportFastq(inFile,fileType,outPrefix,clusterMap,region=None):
+def exportFastq(inFile,fileType,outPrefix,clusterMap,region=None,threads=1):
     cvals  = set(clusterMap.values())
     ofiles ={c : open(f'{outPrefix}.cluster{c}.fastq','w') 
              for c in cvals if c!=-1}
     if fileType == 'bam':
-        inBam  = pysam.AlignmentFile(inFile)
+        inBam  = pysam.AlignmentFile(inFile,threads=threads)
         recGen = inBam.fetch(*getCoordinates(region)) if region else inBam 
     elif fileType == 'fastq':
         recGen = fastqReader(inFile)
@@ -1,13 +1,17 @@
-import os,re,pysam
+import os,re,pysam,threading
+import numpy as np
 import mappy as mp
-from statistics import mean
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice,compress
 from tempfile import NamedTemporaryFile
 
 ALIGNFILTER=0x900
+FLANKBATCH =1000 #reads mapped to flanks per threaded batch
 
-def extractRegion(inBAM,reference,region=None,ctg=None,start=None,stop=None,flanksize=100):
+def extractRegion(inBAM,reference,region=None,ctg=None,start=None,stop=None,flanksize=100,nthreads=1,threads=1):
     ref = pysam.FastaFile(reference)
-    bam = pysam.AlignmentFile(inBAM)
+    bam = pysam.AlignmentFile(inBAM,threads=threads)
     if region:
         try:
             ctg,start,stop = getCoordinates(region)
@@ -18,19 +22,21 @@ def extractRegion(inBAM,reference,region=None,ctg=None,start=None,stop=None,flan
             #catch when missing coord and no region passed
             raise Extract_Exception('Must pass either valid region string or all of ctg,start,stop')
 
-    aligner,tmp = getFlankAligner(ref,ctg,start-1,stop,flanksize=flanksize) 
+    mapper,tmp = getFlankAligner(ref,ctg,start-1,stop,flanksize=flanksize,nthreads=nthreads)
     
     try:
-        for rec in bam.fetch(ctg,start,stop):
-            if (rec.flag & ALIGNFILTER):
-                continue
-            rStart,rStop,subseq = extractRepeat(rec.query_sequence,aligner)
-            if rStart and rStop:
-                name  = f'{rec.query_name}/{rStart}_{rStop}'
-                qual  = rec.query_qualities[rStart:rStop]
-                start = rec.reference_start + rStart
-                end   = rec.reference_end + rStop
-                yield SimpleRecord(name,subseq,start,end,qual,rec.flag)
+        recs    = (rec for rec in bam.fetch(ctg,start,stop) if not (rec.flag & ALIGNFILTER))
+        batches = iter(lambda: list(islice(recs,FLANKBATCH)),[])
+        for batch in batches:
+            alns = mapper.mapBatch([rec.query_sequence for rec in batch])
+            for rec,aln in zip(batch,alns):
+                rStart,rStop,subseq = extractRepeat(rec.query_sequence,aln)
+                if rStart and rStop:
+                    name  = f'{rec.query_name}/{rStart}_{rStop}'
+                    qual  = rec.query_qualities[rStart:rStop]
+                    start = rec.reference_start + rStart
+                    end   = rec.reference_end + rStop
+                    yield SimpleRecord(name,subseq,start,end,qual,rec.flag)
     finally:
         os.remove(tmp.name)
 
@@ -49,20 +55,65 @@ def getFlanks(ref,ctg,start,stop,flanksize=100,Lflank=None,Rflank=None):
     sequence = ref.fetch(ctg,start-Lsize,stop+Rsize)
     return [sequence[:Lsize],sequence[-Rsize:]]
 
-def getFlankAligner(ref,ctg,start,stop,**kwargs):
+def getFlankAligner(ref,ctg,start,stop,nthreads=1,**kwargs):
     tmpRef = NamedTemporaryFile(mode='w',delete=False)
     for side,seq in zip(['L','R'],getFlanks(ref,ctg,start,stop,**kwargs)):
         tmpRef.write('>{n}\n{s}\n'.format(n='_'.join([str(ctg),side]),s=seq))
     tmpRef.close()
-    aligner = mp.Aligner(tmpRef.name,preset='sr')
-    return aligner,tmpRef
+    mapper = FlankMapper(tmpRef.name,nthreads=nthreads)
+    return mapper,tmpRef
+
+class FlankMapper:
+    '''
+    One minimap2 index of flank/primer sequences shared by all reads.
+    Reads are mapped to it in batches by a thread pool, each thread with
+    its own mappy.ThreadBuffer (mappy releases the GIL while mapping).
+    '''
+    def __init__(self,flankFa,nthreads=1,preset='sr'):
+        self.aligner  = mp.Aligner(flankFa,preset=preset)
+        if not self.aligner:
+            raise Extract_Exception(f'Unable to index flanks {flankFa}')
+        self.flanks   = list(self.aligner.seq_names)
+        self.nthreads = os.cpu_count() if nthreads == -1 else max(nthreads or 1,1)
+        self._local   = threading.local()
+
+    def map(self,seq):
+        '''alignments of one read to the flanks'''
+        if not seq:
+            return []
+        if not hasattr(self._local,'buf'):
+            self._local.buf = mp.ThreadBuffer()
+        return list(self.aligner.map(seq,buf=self._local.buf))
+
+    def mapBatch(self,seqs):
+        '''list of alignments for each read in seqs'''
+        if self.nthreads == 1:
+            return list(map(self.map,seqs))
+        with ThreadPoolExecutor(self.nthreads) as pool:
+            return list(pool.map(self.map,seqs))
+
+    def hasFlanks(self,seqs,batchsize=FLANKBATCH):
+        '''boolean array, True for reads where every flank maps exactly once'''
+        seqs = list(seqs)
+        keep = []
+        for i in range(0,len(seqs),batchsize):
+            for aln in self.mapBatch(seqs[i:i+batchsize]):
+                hits = Counter(a.ctg for a in aln)
+                keep.append(all(hits[f] == 1 for f in self.flanks))
+        return np.array(keep,dtype=bool)
+
+    def filterReads(self,recs,batchsize=FLANKBATCH):
+        '''generator of records from recs where every flank maps exactly once'''
+        recs = iter(recs)
+        for batch in iter(lambda: list(islice(recs,batchsize)),[]):
+            yield from compress(batch,self.hasFlanks([rec.query_sequence for rec in batch]))
 
 def getSubSeq(seq,aln):
     pos = sorted([getattr(a,att) for a in aln for att in ['q_st','q_en']])[1:-1]
     return pos + [seq[slice(*pos)]]
 
-def extractRepeat(sequence,aligner):
-    aln = list(aligner.map(sequence))
+def extractRepeat(sequence,aln):
+    '''subsequence between the two flank alignments aln of a read'''
     naln = len(aln)
     if naln == 2:
         start,stop,seq = getSubSeq(sequence,aln)
@@ -80,28 +131,50 @@ def rc(seq):
     '''revcomp'''
     return "".join([_RC_MAP[c] for c in seq[::-1]])
 
+_PHREDACC = 1 - 10**(-np.arange(256)/10) #base accuracy of each phred value
+
 class SimpleRecord:
+    '''
+    Minimal pysam-like record. Qualities are kept as given and converted to a
+    uint8 array on access; rq (mean base accuracy) is only computed when the
+    rq tag is requested, ie when the minQV filter is on.
+    '''
+    __slots__ = ('query_name','query_sequence','reference_start',
+                 'reference_end','flag','_qual','_rq')
     def __init__(self,name,seq,start,end,qual,flag):
         self.query_name      = name
         self.query_sequence  = seq
-        self.query_qualities = self._getQual(qual)
         self.reference_start = start
         self.reference_end   = end
-        self.query_length    = len(seq)
-        self.rq              = self._getRQ(self.query_qualities)
         self.flag            = flag
+        self._qual           = qual
+        self._rq             = None
+    @property
+    def query_length(self):
+        return len(self.query_sequence)
+    @property
+    def query_qualities(self):
+        return None if self._qual is None else self._getQual(self._qual)
+    @property
+    def rq(self):
+        if self._rq is None:
+            self._rq = self._getRQ(self.query_qualities)
+        return self._rq
     def _getQual(self,qual):
-        return qual
+        return np.frombuffer(qual,dtype=np.uint8)
     def _getRQ(self,phred):
-        return mean([1-10**(-q/10) for q in phred])
+        if phred is None:
+            raise Extract_Exception(f'No base qualities for rq in {self.query_name}')
+        return float(_PHREDACC[phred].mean()) if len(phred) else 0.0
     def get_tag(self,tag):
         if tag != 'rq':
             raise Extract_Exception(f'tag {tag} not available')
         return self.rq
 
 class SimpleRecordFq(SimpleRecord):
+    __slots__ = ()
     def _getQual(self,qual):
-        return super()._getQual([ord(q)-33 for q in qual])
+        return np.frombuffer(qual.encode(),dtype=np.uint8) - 33
 
 class Extract_Exception(Exception):
     pass
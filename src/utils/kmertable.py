@@ -0,0 +1,116 @@
+import os,json,hashlib,time,tempfile,zipfile
+import numpy as np
+from scipy import sparse
+
+CACHEVERSION=2
+CACHESIZE   =10      #GB
+FPBYTES     =1 << 20 #bytes hashed at each end of input files
+
+def saveKmerTable(fname,counts,names,kmers,lengths=None):
+    '''
+    Write sparse reads x kmers counts with read names and kmer vocabulary to compressed npz
+    lengths: optional read lengths
+    '''
+    counts = counts.tocsr()
+    extra  = {} if lengths is None else {'lengths':np.asarray(lengths)}
+    np.savez_compressed(fname,
+                        data   =counts.data,
+                        indices=counts.indices,
+                        indptr =counts.indptr,
+                        shape  =np.array(counts.shape),
+                        names  =np.asarray(names,dtype=str),
+                        kmers  =np.asarray(kmers,dtype=str),
+                        **extra)
+    return fname
+
+def loadKmerTable(fname):
+    '''returns (counts,names,kmers,lengths) from saveKmerTable output, lengths None if not saved'''
+    with np.load(fname) as npz:
+        counts = sparse.csr_matrix((npz['data'],npz['indices'],npz['indptr']),
+                                   shape=tuple(npz['shape']))
+        return counts,npz['names'],npz['kmers'],(npz['lengths'] if 'lengths' in npz.files else None)
+
+def fingerprint(fname):
+    '''size, mtime and head/tail content hash of a file'''
+    if not fname:
+        return None
+    stat = os.stat(fname)
+    sha  = hashlib.sha1()
+    with open(fname,'rb') as f:
+        sha.update(f.read(FPBYTES))
+        if stat.st_size > 2*FPBYTES:
+            f.seek(-FPBYTES,os.SEEK_END)
+            sha.update(f.read())
+        else:
+            sha.update(f.read())
+    return [stat.st_size,stat.st_mtime,sha.hexdigest()]
+
+class KmerCache:
+    '''
+    Directory of trimmed kmer tables keyed by input files and feature parameters.
+    Least recently used tables are evicted past maxGB.
+    '''
+    def __init__(self,cacheDir,maxGB=CACHESIZE):
+        self.dir   = cacheDir
+        self.maxGB = maxGB
+        os.makedirs(cacheDir,exist_ok=True)
+
+    def key(self,files,**params):
+        '''hash of input file fingerprints and every feature parameter'''
+        desc = {'version':CACHEVERSION,
+                'files'  :[fingerprint(f) for f in files],
+                'params' :params}
+        return hashlib.sha1(json.dumps(desc,sort_keys=True,default=str).encode()).hexdigest()
+
+    def _path(self,key,ext):
+        return os.path.join(self.dir,f'{key}.{ext}')
+
+    def load(self,key):
+        '''returns (counts,names,kmers,lengths) or None if not cached'''
+        path = self._path(key,'npz')
+        if not os.path.exists(path):
+            return None
+        try:
+            table = loadKmerTable(path)
+        except (OSError,EOFError,ValueError,KeyError,zipfile.BadZipFile):
+            #partial or stale entry
+            self._remove(key)
+            return None
+        os.utime(path) #mark recently used
+        return table
+
+    def save(self,key,counts,names,kmers,lengths=None,**meta):
+        #write beside the entry and rename, so an interrupted run leaves no partial table
+        fd,tmp = tempfile.mkstemp(dir=self.dir,suffix='.tmp')
+        try:
+            with os.fdopen(fd,'wb') as f:
+                saveKmerTable(f,counts,names,kmers,lengths)
+            os.replace(tmp,self._path(key,'npz'))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        meta.update({'created':time.strftime('%Y-%m-%d %H:%M:%S'),
+                     'nreads' :counts.shape[0],
+                     'nkmers' :counts.shape[1]})
+        with open(self._path(key,'json'),'w') as f:
+            json.dump(meta,f,indent=1,default=str)
+        self.evict(keep=key)
+
+    def evict(self,keep=None):
+        '''drop least recently used tables until the cache fits maxGB'''
+        entries = sorted((os.path.getmtime(p),os.path.getsize(p),name[:-4])
+                         for name in os.listdir(self.dir) if name.endswith('.npz')
+                         for p in [os.path.join(self.dir,name)])
+        total   = sum(size for _,size,_ in entries)
+        for _,size,key in entries:
+            if total <= self.maxGB * 1e9:
+                break
+            if key == keep:
+                continue
+            self._remove(key)
+            total -= size
+
+    def _remove(self,key):
+        for ext in ['npz','json']:
+            if os.path.exists(self._path(key,ext)):
+                os.remove(self._path(key,ext))
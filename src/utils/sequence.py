@@ -0,0 +1,192 @@
+import numpy as np
+from functools import partial
+from hashlib import blake2b
+
+BASES    ='ACGT'
+AMBIG    =4  #code for any non-ACGT character
+MAXCODEK =31 #longest kmer with a 2-bit code that fits in int64
+ORIENTK  =15 #minimizer kmer size for read orientation
+ORIENTW  =10 #minimizer window for read orientation
+ORIENTVOTES=3 #min minimizer vote margin placing a read on a strand
+EMPTYHASH=np.iinfo(np.uint64).max
+
+_COMP   = str.maketrans('ACGTacgt','TGCAtgca')
+
+_ENCODE = np.full(256,AMBIG,dtype=np.uint8)
+for _i,_b in enumerate(BASES):
+    _ENCODE[ord(_b)] = _i
+
+def seqBytes(seq):
+    '''uint8 view of a sequence string'''
+    return np.frombuffer(seq.encode(),dtype=np.uint8)
+
+def encodeSeq(seq):
+    '''2-bit encode a sequence string (or byte array) into a uint8 array. Non-ACGT are AMBIG'''
+    return _ENCODE[seqBytes(seq) if isinstance(seq,str) else seq]
+
+def hpMask(arr,maxLen=1,breaks=None):
+    '''
+    Run-length mask keeping the first maxLen bases of each homopolymer run
+    arr    : uint8 byte view of sequence(s)
+    breaks : positions that always start a new run (eg read starts in a batch)
+    '''
+    n   = len(arr)
+    new = np.ones(n,dtype=bool)
+    new[1:] = arr[1:] != arr[:-1]
+    if breaks is not None:
+        new[breaks[breaks < n]] = True
+    starts = np.flatnonzero(new)
+    runpos = np.arange(n) - np.repeat(starts,np.diff(np.append(starts,n)))
+    return runpos < maxLen
+
+def collapseSeq(seq,maxLen=1,coords=False):
+    '''
+    Collapse homopolymers to at most maxLen bases
+    coords : also return the original position of each collapsed base
+    '''
+    arr = seqBytes(seq)
+    idx = np.flatnonzero(hpMask(arr,maxLen))
+    out = arr[idx].tobytes().decode()
+    return (out,idx) if coords else out
+
+def hpCollapse(maxLen=1):
+    '''picklable function collapsing homopolymers to at most maxLen bases'''
+    return partial(collapseSeq,maxLen=maxLen)
+
+def windowCount(flags,w):
+    '''number of set flags in every w-length window of a boolean array'''
+    csum = np.concatenate([[0],np.cumsum(flags,dtype=np.int64)])
+    return csum[w:] - csum[:-w]
+
+def kmerCodes(codes,k):
+    '''
+    Integer code of every k-length window of an encoded array, built by
+    rolling 2-bit shifts over the whole array at once.
+    Windows containing AMBIG bases get meaningless codes; mask them with
+    windowCount(codes==AMBIG,k).
+    '''
+    n   = len(codes) - k + 1
+    out = np.zeros(max(n,0),dtype=np.int64)
+    if n <= 0:
+        return out
+    vals = np.minimum(codes,3).astype(np.int64)
+    for j in range(k):
+        out <<= 2
+        out |= vals[j:j+n]
+    return out
+
+def slidingMin(arr,w):
+    '''
+    Minimum of every w-length window in one pass (van Herk/Gil-Werman).
+    Block prefix and suffix minima are the vectorized form of a monotone queue,
+    so cost does not depend on w.
+    '''
+    n = len(arr) - w + 1
+    if n <= 0:
+        return arr[:0].copy()
+    if w == 1:
+        return arr.copy()
+    pad    = -len(arr) % w
+    blocks = np.append(arr,np.full(pad,np.iinfo(arr.dtype).max,dtype=arr.dtype)).reshape(-1,w)
+    prefix = np.minimum.accumulate(blocks,axis=1).ravel()
+    suffix = np.minimum.accumulate(blocks[:,::-1],axis=1)[:,::-1].ravel()
+    return np.minimum(suffix[:n],prefix[w-1:w-1+n])
+
+def revcompSeq(seq):
+    '''reverse complement of a sequence string'''
+    return seq.translate(_COMP)[::-1]
+
+def canonicalKmer(kmer):
+    '''lesser of a kmer string and its reverse complement'''
+    return min(kmer,revcompSeq(kmer))
+
+def revcompCodes(codes):
+    '''reverse complement of an encoded array, AMBIG stays AMBIG'''
+    return np.where(codes==AMBIG,AMBIG,3-codes).astype(np.uint8)[::-1]
+
+def canonicalCodes(codes,k):
+    '''
+    Strand-agnostic code of every k-length window: the lesser of the forward
+    code and the code of its reverse complement (same order as canonicalKmer)
+    '''
+    return np.minimum(kmerCodes(codes,k),kmerCodes(revcompCodes(codes),k)[::-1])
+
+def minimizerSet(seq,k=ORIENTK,w=ORIENTW):
+    '''
+    distinct (w,k) minimizers of a sequence, ordered by hash so low-complexity
+    kmers are not favored; kmers with non-ACGT bases are skipped
+    '''
+    codes = encodeSeq(seq)
+    kc    = mix64(kmerCodes(codes,k))
+    kc[windowCount(codes==AMBIG,k) > 0] = EMPTYHASH
+    mins  = slidingMin(kc,w)
+    return np.unique(mins[mins != EMPTYHASH])
+
+def orientSeqs(seqs,template='median',k=ORIENTK,w=ORIENTW,minVotes=ORIENTVOTES):
+    '''
+    Strand of each read relative to a template read (first or median length).
+    Reads vote with their minimizers found in the template vs found in its
+    reverse complement, and are placed if one strand wins by at least
+    minVotes and twice the other.  Unplaced reads (eg not overlapping the
+    template) vote again against all reads placed so far, until no more
+    reads are placed; the rest keep their strand
+    returns bool array, True for reads to reverse complement
+    '''
+    n      = len(seqs)
+    flip   = np.zeros(n,dtype=bool)
+    if n == 0:
+        return flip
+    t      = 0 if template == 'first' else np.argsort(list(map(len,seqs)),kind='stable')[n//2]
+    fwd    = [minimizerSet(seq,k,w) for seq in seqs]
+    rev    = [minimizerSet(revcompSeq(seq),k,w) for seq in seqs]
+    rowF   = np.repeat(np.arange(n),list(map(len,fwd)))
+    rowR   = np.repeat(np.arange(n),list(map(len,rev)))
+    fwd,rev = np.concatenate(fwd),np.concatenate(rev)
+    placed = np.zeros(n,dtype=bool)
+    placed[t] = True
+    pool   = fwd[rowF == t]
+    while True:
+        nf     = np.bincount(rowF,weights=np.isin(fwd,pool),minlength=n)
+        nr     = np.bincount(rowR,weights=np.isin(rev,pool),minlength=n)
+        new    = ~placed & (np.abs(nf - nr) >= minVotes) & (np.maximum(nf,nr) >= 2*np.minimum(nf,nr))
+        if not new.any():
+            break
+        flip[new]   = nr[new] > nf[new]
+        placed[new] = True
+        pool   = np.unique(np.concatenate([pool,
+                                           fwd[new[rowF] & ~flip[rowF]],
+                                           rev[new[rowR] & flip[rowR]]]))
+    return flip
+
+def kmerCode(kmer):
+    '''2-bit integer code of a single kmer string, None if it has non-ACGT bases'''
+    codes = encodeSeq(kmer)
+    if len(kmer) > MAXCODEK or np.any(codes==AMBIG):
+        return None
+    return int(kmerCodes(codes,len(kmer))[0])
+
+def stringKey(kmer):
+    '''stable 63-bit integer key for a kmer string without a 2-bit code'''
+    return int.from_bytes(blake2b(kmer.encode(),digest_size=8).digest(),'little') >> 1
+
+def mix64(keys):
+    '''splitmix64 finalizer: uniform uint64 hash of integer keys'''
+    x  = np.asarray(keys).astype(np.uint64)
+    x  = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x  = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+def hashCodes(keys,nFeatures):
+    '''
+    Signed feature hashing (splitmix64 mix) of integer keys
+    returns (bucket,sign): bucket in [0,nFeatures) and +/-1 from the top hash bit
+    '''
+    x      = mix64(keys)
+    bucket = (x % np.uint64(nFeatures)).astype(np.int64)
+    sign   = np.where(x >> np.uint64(63),-1,1).astype(np.int16)
+    return bucket,sign
+
+def decodeKmer(code,k):
+    '''kmer string for a 2-bit integer code'''
+    return ''.join(BASES[(code >> 2*(k-1-i)) & 3] for i in range(k))
@@ -16,16 +16,19 @@ parser.add_argument('--sep',help='column separator. default <space>',
                     type=str,default=' ')
 parser.add_argument('--header',action='store_true',help='treat first row as column headers. default no header',
                     default=False)
+parser.add_argument('--threads',help='threads for BAM compression/decompression and indexing. default 1',
+                    type=int,default=1)
 
 args = parser.parse_args()
 
 class arghandle:
-    def __init__(self,inbam):
+    def __init__(self,inbam,threads=1):
         self.inBAM    = inbam
         self.drop     = False
         self.splitBam = False
         self.prog     ='foo'
         self.region   = None
+        self.threads  = threads
 
 table = pd.read_csv(args.readInfo,sep=args.sep,header=0 if args.header else None)
 
@@ -33,5 +36,5 @@ print('making clustermap')
 clustermap = dict(table[[args.names,args.cluster]].values) 
 
 print('tagging bam')
-addHPtag(arghandle(args.inbam),args.outbam,clustermap)
+addHPtag(arghandle(args.inbam,args.threads),args.outbam,clustermap)
 print('Done')